@@ -249,6 +249,74 @@ function fetchJson(url, callback = null, callbackError = null) {
     }); 
 };  
 
+// orbits.py writes the orbit JSON column by column by default:
+//     {"format": "columnar", "bodies": {id: {"elements": {field: [...]}, "vectors": {field: [...]}}}}
+// This turns it back into the record layout used everywhere else ({id: {"elements": {jd: record}, "vectors": [record]}}).
+// Files in the record layout (orbits.py --json-legacy) are returned as they are.
+function normalizeOrbitData(data) {
+    if (data.format !== "columnar") return data;
+
+    function columnsToRecords(columns) {
+        var fields = Object.keys(columns);
+        var count = fields.length ? columns[fields[0]].length : 0;
+        var records = new Array(count);
+        for (var i = 0; i < count; i++) {
+            var record = {};
+            for (var f = 0; f < fields.length; f++) {
+                record[fields[f]] = columns[fields[f]][i];
+            }
+            records[i] = record;
+        }
+        return records;
+    }
+
+    var orbits = {};
+    for (var id in data.bodies) {
+        var body = data.bodies[id];
+        orbits[id] = {};
+        if (body.elements) {
+            var elements = {};
+            columnsToRecords(body.elements).forEach(function(record) {
+                elements[record.jdct.toFixed(9)] = record;
+            });
+            orbits[id]["elements"] = elements;
+        }
+        if (body.vectors) {
+            orbits[id]["vectors"] = columnsToRecords(body.vectors);
+        }
+    }
+    return orbits;
+}
+
+// orbits.py --append writes the rows fetched after the first run as segments <name>-<n>.json, listed in
+// <name>_segments.json. This loads the main file and then the segments, if any, in order, and appends
+// their vectors to those of the main file. The callbacks get the normalized record layout.
+function fetchOrbitData(url, callback, callbackError) {
+    fetchJson(url, function(data) {
+        var orbits = normalizeOrbitData(data);
+        var base = url.replace(/\.json$/, "");
+        fetch(base + "_segments.json", { headers: { 'accept': 'application/json; charset=utf8;' } })
+          .then(r => { return r.ok ? r.json() : { segments: [] }; })
+          .then(manifest => {
+            var dir = url.substring(0, url.lastIndexOf("/") + 1);
+            return Promise.all(manifest.segments.map(segment =>
+                fetch(dir + segment.name + ".json").then(r => { return r.json(); })));
+          })
+          .then(segments => {
+            segments.forEach(function(segment) {
+                var more = normalizeOrbitData(segment);
+                for (var id in more) {
+                    if (!orbits[id]) orbits[id] = {};
+                    if (more[id].elements) orbits[id].elements = Object.assign(orbits[id].elements || {}, more[id].elements);
+                    if (more[id].vectors) orbits[id].vectors = (orbits[id].vectors || []).concat(more[id].vectors);
+                }
+            });
+            callback(orbits);
+          })
+          .catch(err => { if (callbackError !== null) callbackError(err); });
+    }, callbackError);
+}
+
 function getStartAndEndTimes(id) {
 
     // Note: we should keep end times 1 minute (current resolution) less than the last orbit data point time argument
@@ -3751,7 +3819,7 @@ function processOrbitData(data) {
 function loadLandingDataAndProcess() {
     if (!landingDataLoaded) {
         var landingDataJson = "landing-CY3.json";
-        fetchJson(landingDataJson, async function(data) {
+        fetchOrbitData(landingDataJson, async function(data) {
 
             // console.log("Landing orbit data load from " + landingDataJson + ": OK");
             landingDataLoaded = true;
@@ -3777,7 +3845,7 @@ function loadOrbitDataIfNeededAndProcess(callback) {
         d3.select("#progressbar-label").html(msg);
         sleep().then();
 
-        fetchJson(animationScenes[config].orbitsJson, function(data) {
+        fetchOrbitData(animationScenes[config].orbitsJson, function(data) {
 
             // console.log("Orbit data load from " + animationScenes[config].orbitsJson + ": OK");
             dataLoaded = true;
@@ -10,9 +10,30 @@ from datetime import datetime
 import calendar
 import requests
 import json
-from datetime import datetime, timezone
-import re
+from datetime import datetime, timezone, timedelta
+import hashlib
+import gzip
+import shutil
+import tempfile
+import bisect
+import threading
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
+from requests.adapters import HTTPAdapter
+
+try:
+    import resource  # peak RSS for --profile; not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import brotli  # optional, for --json-compress br
+except ImportError:
+    brotli = None
 
 # constants - ephemerides related
 
@@ -59,7 +80,25 @@ phase = None
 use_cached_data = False
 date = datetime.now().strftime('%Y%m%d')
 data_dir = os.path.join("data-fetched", date)
-debugging = True
+log_level = "INFO"  # one of DEBUG, INFO, WARNING, ERROR -- see setup_logging
+
+logger = logging.getLogger("orbits")
+
+# Horizons fetch engine settings -- overridable from the command line
+
+horizons_url = "https://ssd.jpl.nasa.gov/horizons_batch.cgi"
+max_concurrency = 4           # cap on in-flight Horizons requests
+fetch_retries = 3             # retries per request after the first attempt
+fetch_backoff_seconds = 2.0   # first retry delay; doubled on every further retry
+fetch_timeout_seconds = 300
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+chunk_days = 5.0              # vector ranges are split into sub-windows of this length; 0 disables
+
+# Horizons response cache -- entries are keyed by a hash of the full query, so they stay valid across days
+
+cache_dir = "horizons-cache"
+cache_max_bytes = 1024 * 1024 * 1024  # least recently used entries are evicted beyond this size
 
 config = {
     "geo": {
@@ -76,7 +115,7 @@ config = {
 
         'center'               : JPL_EARTH_CENTER,
 
-        'orbits_file'   : f"{data_dir}/geo-CY3"
+        'orbits_file'   : "geo-CY3"
     },
     "lunar": {
         'start_year'           : '2023', 'start_month'           : '07', 'start_day'           : '14', 'start_hour'              : '09', 'start_minute'             : '23', 
@@ -92,7 +131,7 @@ config = {
 
         'center'               : JPL_MOON_CENTER,
 
-        'orbits_file'          : f"{data_dir}/lunar-CY3"
+        'orbits_file'          : "lunar-CY3"
     },
     "lro": {
         'start_year'           : '2023', 'start_month'           : '07', 'start_day'           : '14', 'start_hour'              : '09', 'start_minute'             : '23', 
@@ -108,7 +147,9 @@ config = {
 
         'center'               : JPL_MOON_CENTER,
 
-        'orbits_file'          : f"{data_dir}/lunar-lro"
+        'orbits_file'          : "lunar-lro",
+
+        'open_ended'           : True, # LRO is still flying, so --stop-time may move the stop past the configured one
     },
     "landing": {
         'start_year'           : '2023', 'start_month'           : '08', 'start_day'           : '23', 'start_hour'              : '12', 'start_minute'             : '15', 
@@ -118,36 +159,18 @@ config = {
         'start_year_vikram'    : '2023', 'start_month_vikram'    : '08', 'start_day_vikram'    : '23', 'start_hour_vikram'       : '12', 'start_minute_vikram'      : '15',
         'stop_year_vikram'     : '2023', 'stop_month_vikram'     : '08', 'stop_day_vikram'     : '23', 'stop_hour_vikram'        : '12', 'stop_minute_vikram'       : '40',
 
-        'step_size_in_minutes' : 1500, # TODO jugaad to get 1800 seconds of data -- see below
+        'step_size_in_minutes' : 1,
+        'schedule'             : [("2023-08-23 12:15", "2023-08-23 12:40", "1 s")], # powered descent
 
         'planets'              : ["CY3"], # TODO Add Vikram later
 
         'center'               : JPL_MOON_CENTER,
 
-        'orbits_file'          : f"{data_dir}/landing-CY3"
+        'orbits_file'          : "landing-CY3"
     },
 }
 
-# Initialize variables
-start_year, start_month, start_day, start_hour, start_minute = None, None, None, None, None
-stop_year, stop_month, stop_day, stop_hour, stop_minute = None, None, None, None, None
-start_year_CY3, start_month_CY3, start_day_CY3, start_hour_CY3, start_minute_CY3 = None, None, None, None, None
-stop_year_CY3, stop_month_CY3, stop_day_CY3, stop_hour_CY3, stop_minute_CY3 = None, None, None, None, None
-step_size_in_minutes = None
-start_year_vikram, start_month_vikram, start_day_vikram, start_hour_vikram, start_minute_vikram = None, None, None, None, None
-stop_year_vikram, stop_month_vikram, stop_day_vikram, stop_hour_vikram, stop_minute_vikram = None, None, None, None, None
-
-planets = []
-center = None
-orbits_file = None
-
-# global data structures
-
-start_time_gm = 0  # set later in code
-stop_time_gm = 0   # set later in code
-start_time = ''    # set later in code 
-stop_time = ''     # set later in code
-step_size = ''     # set later in code
+stop_time_override = None  # datetime that replaces the stop time of the phases, from --stop-time; see PhaseRun.override_stop_time
 
 now = time.time()
 
@@ -156,178 +179,363 @@ def my_jd(t):
 
 jd = my_jd(now)
 gmtime = time.gmtime(now)
-orbits_raw = {}
-orbits = {}
+
+class PhaseRun:
+    # Everything one phase's run works on: its configuration and time window, the cache files of its
+    # Horizons responses (orbits_raw) and the parsed tables (orbits). Several runs can coexist in a process.
+
+    def __init__(self, phase, data_dir, raw_dir=None):
+        self.phase = phase
+        self.data_dir = data_dir
+        self.raw_dir = raw_dir or data_dir  # where the ho-*.txt dumps go
+
+        # start_year ... stop_minute_vikram, step_size_in_minutes, planets, center and optionally a schedule:
+        # (start, stop, step) windows sampled at another step than step_size_in_minutes, see plan_fetch_schedule
+        self.schedule = []
+        self.open_ended = False
+        for key, value in config[phase].items():
+            setattr(self, key, value)
+        self.orbits_file = os.path.join(data_dir, config[phase]['orbits_file'])
+        self.archive_base = self.orbits_file  # with --append the other outputs move on to a segment, see start_append_segment
+
+        self.orbits_raw = {}
+        self.orbits = {}
+        self.derived = {}  # planet -> OrbitTable of derived quantities, see compute_derived_quantities
+        self.element_series = {}  # planet -> OrbitTable of osculating elements, see compute_element_series
+        self.lod = {}  # planet -> Douglas-Peucker significance of every vectors sample, see build_lod_pyramid
+        self.events = []
+        self.archived = {}  # planet -> vectors already in the archive, with --append; see load_archive_for_append
+        self.append_from = {}  # planet -> last archived jdct
+        self.segments = None  # the segment manifest with the one being written, see start_append_segment
+        self.invalid = None  # why the run can't go ahead, checked by run_phase and run_phases
+        self.set_start_and_stop_times()
+        if stop_time_override is not None:
+            self.override_stop_time(stop_time_override)
+
+    def override_stop_time(self, stop):
+        # --stop-time cuts any phase short, but only moves the stop of an open-ended phase past the configured
+        # one: a fixed phase like the 25 minute landing would otherwise be stretched to the new stop at its own
+        # step. A stop before the start of the phase leaves the run invalid.
+        starts = [parse_horizons_time(get_horizons_start_time(self, planet)) for planet in ("CY3", None)]
+        if stop <= max(starts):
+            self.invalid = f"--stop-time {format_horizons_time(stop)} is not after the start of the {self.phase} phase, {format_horizons_time(max(starts))}"
+            return
+        if stop > datetime(1970, 1, 1) + timedelta(seconds=self.stop_time_gm) and not self.open_ended:
+            print_debug("Keeping the configured stop of the %s phase, which isn't open-ended", self.phase)
+            return
+        fields = zip(('year', 'month', 'day', 'hour', 'minute'), stop.strftime("%Y %m %d %H %M").split())
+        for field, value in fields:
+            for suffix in ('', '_CY3'):
+                setattr(self, f"stop_{field}{suffix}", value)
+        self.set_start_and_stop_times()
+
+    def set_start_and_stop_times(self):
+        self.start_time = f"{self.start_year}-{self.start_month}-{self.start_day}"
+        self.start_time_gm = calendar.timegm((int(self.start_year), int(self.start_month), int(self.start_day),
+                                              int(self.start_hour), int(self.start_minute), 0))
+
+        self.stop_time = f"{self.stop_year}-{self.stop_month}-{self.stop_day}"
+        self.stop_time_gm = calendar.timegm((int(self.stop_year), int(self.stop_month), int(self.stop_day),
+                                             int(self.stop_hour), int(self.stop_minute), 0))
+
+        self.step_size = f"{self.step_size_in_minutes} m"
+
+        # Calculate JD for start time
+        self.jd = my_jd(self.start_time_gm)
 
 def filename_for_planet(fn):
     retfn = fn.replace('/', '_')
-    print_debug(f"planet={fn}, filename={retfn}")
+    print_debug("planet=%s, filename=%s", fn, retfn)
     return retfn
 
-def init_config(option):
-    global start_year, start_month, start_day, start_hour, start_minute
-    global stop_year, stop_month, stop_day, stop_hour, stop_minute
-    global start_year_CY3, start_month_CY3, start_day_CY3, start_hour_CY3, start_minute_CY3
-    global stop_year_CY3, stop_month_CY3, stop_day_CY3, stop_hour_CY3, stop_minute_CY3
-    global start_year_vikram, start_month_vikram, start_day_vikram, start_hour_vikram, start_minute_vikram
-    global stop_year_vikram, stop_month_vikram, stop_day_vikram, stop_hour_vikram, stop_minute_vikram
-    global step_size_in_minutes, planets, center, orbits_file
-
-    start_year = config[option]['start_year']
-    start_month = config[option]['start_month']
-    start_day = config[option]['start_day']
-    start_hour = config[option]['start_hour']
-    start_minute = config[option]['start_minute']
-
-    stop_year = config[option]['stop_year']
-    stop_month = config[option]['stop_month']
-    stop_day = config[option]['stop_day']
-    stop_hour = config[option]['stop_hour']
-    stop_minute = config[option]['stop_minute']
-
-    start_year_CY3 = config[option]['start_year_CY3']
-    start_month_CY3 = config[option]['start_month_CY3']
-    start_day_CY3 = config[option]['start_day_CY3']
-    start_hour_CY3 = config[option]['start_hour_CY3']
-    start_minute_CY3 = config[option]['start_minute_CY3']
-    
-    start_year_vikram = config[option]['start_year_vikram']
-    start_month_vikram = config[option]['start_month_vikram']
-    start_day_vikram = config[option]['start_day_vikram']
-    start_hour_vikram = config[option]['start_hour_vikram']
-    start_minute_vikram = config[option]['start_minute_vikram']
-
-    stop_year_CY3 = config[option]['stop_year_CY3']
-    stop_month_CY3 = config[option]['stop_month_CY3']
-    stop_day_CY3 = config[option]['stop_day_CY3']
-    stop_hour_CY3 = config[option]['stop_hour_CY3']
-    stop_minute_CY3 = config[option]['stop_minute_CY3']
-
-    stop_year_vikram = config[option]['stop_year_vikram']
-    stop_month_vikram = config[option]['stop_month_vikram']
-    stop_day_vikram = config[option]['stop_day_vikram']
-    stop_hour_vikram = config[option]['stop_hour_vikram']
-    stop_minute_vikram = config[option]['stop_minute_vikram']
-
-    step_size_in_minutes = config[option]['step_size_in_minutes']
-
-    planets = config[option]['planets']
-
-    center = config[option]['center']
-
-    orbits_file = config[option]['orbits_file']
-
-def print_config():
-    print(f"(start_year, start_month, start_day, start_hour, start_minute) = ({start_year}, {start_month}, {start_day}, {start_hour}, {start_minute})")
-    print(f"(stop_year, stop_month, stop_day, stop_hour, stop_minute) = ({stop_year}, {stop_month}, {stop_day}, {stop_hour}, {stop_minute})")
-    print(f"step_size_in_minutes = {step_size_in_minutes}")
-    print(f"planets = {', '.join(planets)}")
-    print(f"orbits_file = {orbits_file}")
-
-def get_horizons_start_time(planet):
+def print_config(run):
+    print(f"phase = {run.phase}")
+    print(f"(start_year, start_month, start_day, start_hour, start_minute) = ({run.start_year}, {run.start_month}, {run.start_day}, {run.start_hour}, {run.start_minute})")
+    print(f"(stop_year, stop_month, stop_day, stop_hour, stop_minute) = ({run.stop_year}, {run.stop_month}, {run.stop_day}, {run.stop_hour}, {run.stop_minute})")
+    print(f"step_size_in_minutes = {run.step_size_in_minutes}")
+    for start, stop, step in run.schedule:
+        print(f"step {step} from {start} to {stop}")
+    print(f"planets = {', '.join(run.planets)}")
+    print(f"orbits_file = {run.orbits_file}")
+
+def get_horizons_start_time(run, planet):
     if planet == "CY3":
-        return f"{start_year_CY3}-{start_month_CY3}-{start_day_CY3} {start_hour_CY3}:{start_minute_CY3}"
+        return f"{run.start_year_CY3}-{run.start_month_CY3}-{run.start_day_CY3} {run.start_hour_CY3}:{run.start_minute_CY3}"
     elif planet == "VIKRAM":
-        return f"{start_year_vikram}-{start_month_vikram}-{start_day_vikram} {start_hour_vikram}:{start_minute_vikram}"
+        return f"{run.start_year_vikram}-{run.start_month_vikram}-{run.start_day_vikram} {run.start_hour_vikram}:{run.start_minute_vikram}"
     else:
-        return f"{start_year}-{start_month}-{start_day} {start_hour}:{start_minute}"
+        return f"{run.start_year}-{run.start_month}-{run.start_day} {run.start_hour}:{run.start_minute}"
 
-def get_horizons_stop_time(planet):
+def get_horizons_stop_time(run, planet):
     if planet == "CY3":
-        return f"{stop_year_CY3}-{stop_month_CY3}-{stop_day_CY3} {stop_hour_CY3}:{stop_minute_CY3}"
+        return f"{run.stop_year_CY3}-{run.stop_month_CY3}-{run.stop_day_CY3} {run.stop_hour_CY3}:{run.stop_minute_CY3}"
     elif planet == "VIKRAM":
-        return f"{stop_year_vikram}-{stop_month_vikram}-{stop_day_vikram} {stop_hour_vikram}:{stop_minute_vikram}"
+        return f"{run.stop_year_vikram}-{run.stop_month_vikram}-{run.stop_day_vikram} {run.stop_hour_vikram}:{run.stop_minute_vikram}"
     else:
-        return f"{stop_year}-{stop_month}-{stop_day} {stop_hour}:{stop_minute}"    
-    
-
-def set_start_and_stop_times():
-    global start_time, start_time_gm, stop_time, stop_time_gm, step_size, jd
-
-    start_time = f"{start_year}-{start_month}-{start_day}"
-    start_time_gm = calendar.timegm((int(start_year), int(start_month), int(start_day), 
-                                     int(start_hour), int(start_minute), 0))
-
-    stop_time = f"{stop_year}-{stop_month}-{stop_day}"
-    stop_time_gm = calendar.timegm((int(stop_year), int(stop_month), int(stop_day), 
-                                    int(stop_hour), int(stop_minute), 0))
-
-    step_size = f"{step_size_in_minutes}" + ("" if phase == "landing" else " m")  # TODO jugaad for landing resolution
-
-    # Calculate JD for start time
-    jd = my_jd(start_time_gm)
-
-def print_debug(msg):
-    if debugging:
-        print(f"DEBUG: {msg}")
+        return f"{run.stop_year}-{run.stop_month}-{run.stop_day} {run.stop_hour}:{run.stop_minute}"
+
+def setup_logging(level):
+    # Debug and info messages go to stdout, warnings and errors to stderr. Without this, as when orbits.py is
+    # imported, only warnings and errors are shown and print_debug returns after one level check.
+    logger.handlers.clear()
+    logger.setLevel(level)
+    logger.propagate = False
+    formatter = logging.Formatter("%(levelname)s: %(message)s")
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    for handler in (stdout_handler, stderr_handler):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+def print_debug(msg, *args):
+    # Arguments are %-formatted into msg by logging, only when debug messages are shown
+    logger.debug(msg, *args)
 
 def print_error(msg):
-    print(f"Error: {msg}", file=sys.stderr)
-
-def my_jd(t):
-    return 2440587.5 + (t / 86400)
-
-def is_craft(planet):
-    return (planet < 0) or ((planet == "MOON") and (phase == "geo"))
-
-def save_fetched_data():
+    logger.error(msg)
+
+# Profiling: wall and CPU time, calls, rows and bytes per pipeline stage, and the peak RSS at the end of each
+# stage. Off unless --profile is given, in which case the instrumented functions cost one flag test per call.
+# CPU time is that of the calling thread, so concurrent fetches each count their own.
+
+profiling = False
+profile_stages = {}
+profile_lock = threading.Lock()
+
+def peak_rss_bytes():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KiB elsewhere
+
+def profile_record(name, wall=0.0, cpu=0.0, calls=0, rows=0, nbytes=0):
+    if not profiling:
+        return
+    with profile_lock:
+        stage = profile_stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                 'rows': 0, 'bytes': 0, 'peak_rss_bytes': 0})
+        stage['calls'] += calls
+        stage['wall_seconds'] += wall
+        stage['cpu_seconds'] += cpu
+        stage['rows'] += rows
+        stage['bytes'] += nbytes
+        stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], peak_rss_bytes())
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def profiled(name, outputs=None):
+    # Times every call of the decorated function as stage name. For the writers, outputs(run) lists the files
+    # they produce; their sizes and the run's row count are then added to the stage.
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not profiling:
+                return fn(*args, **kwargs)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+                rows = nbytes = 0
+                if outputs is not None:
+                    run = args[0]
+                    rows = sum(len(table) for data in run.orbits.values() for table in data.values())
+                    nbytes = sum(path_size(path) for path in outputs(run))
+                profile_record(name, wall, cpu, 1, rows, nbytes)
+        return wrapper
+    return decorate
+
+def merge_profile(stages):
+    # Adds the stages of another process, e.g. a batch worker
+    for name, other in stages.items():
+        profile_record(name, other['wall_seconds'], other['cpu_seconds'], other['calls'], other['rows'], other['bytes'])
+        with profile_lock:
+            stage = profile_stages[name]
+            stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], other['peak_rss_bytes'])
+
+def profile_report(wall_seconds):
+    report = {
+        'argv': sys.argv[1:],
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': time.process_time(),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': profile_stages,
+    }
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)  # batch workers that have exited
+        report['children_cpu_seconds'] = children.ru_utime + children.ru_stime
+        report['children_peak_rss_bytes'] = children.ru_maxrss if sys.platform == 'darwin' else children.ru_maxrss * 1024
+    return report
+
+def print_profile(report):
+    print(f"Profile: {report['wall_seconds']:.2f} s wall, {report['cpu_seconds']:.2f} s CPU, "
+          f"peak RSS {report['peak_rss_bytes'] / 1e6:.1f} MB")
+    if report.get('children_cpu_seconds'):
+        print(f"  child processes: {report['children_cpu_seconds']:.2f} s CPU, "
+              f"peak RSS {report['children_peak_rss_bytes'] / 1e6:.1f} MB")
+    print(f"  {'stage':<16} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'rows':>10} {'MB':>9} {'peak RSS MB':>12}")
+    for name, stage in sorted(profile_stages.items(), key=lambda item: -item[1]['wall_seconds']):
+        print(f"  {name:<16} {stage['calls']:>6} {stage['wall_seconds']:>9.3f} {stage['cpu_seconds']:>9.3f} "
+              f"{stage['rows']:>10} {stage['bytes'] / 1e6:>9.2f} {stage['peak_rss_bytes'] / 1e6:>12.1f}")
+
+def is_craft(run, planet):
+    return (planet < 0) or ((planet == "MOON") and (run.phase == "geo"))
+
+@profiled('save raw', outputs=lambda run: [run.raw_dir])
+def save_fetched_data(run):
+    # With --append the vectors fetched after the archive go to a dump of their own, named after the start of
+    # the window, so that the dumps of the earlier windows are kept
     try:
-        cache_file_name = f"{data_dir}/momcache.txt"
-        try:
-            with open(cache_file_name, 'w') as fh:
-                fh.write(f"jd={jd}\n")
-        except IOError as e:
-            print_error(f"Failed to write to {cache_file_name}: {e}")
-            return False
-
-        for planet in planets:
+        os.makedirs(run.raw_dir, exist_ok=True)
+        for planet in run.planets:
             fn = filename_for_planet(planet)
             
-            ho_file_name = f"{data_dir}/ho-{fn}-elements.txt"
-            try:
-                with open(ho_file_name, 'w') as fh:
-                    horizons = orbits_raw[planet]['elements_content']
-                    fh.write(horizons)
-            except IOError as e:
-                print_error(f"Can't write to {ho_file_name}: {e}")
-                return False
-
-            ho_file_name = f"{data_dir}/ho-{fn}-vectors.txt"
-            try:
-                with open(ho_file_name, 'w') as fh:
-                    horizons = orbits_raw[planet]['vectors_content']
-                    fh.write(horizons)
-            except IOError as e:
-                print_error(f"Can't write to {ho_file_name}: {e}")
-                return False
+            for key in ['elements', 'vectors']:
+                if f"{key}_chunks" not in run.orbits_raw[planet]:
+                    continue
+                ho_file_name = f"{run.raw_dir}/ho-{fn}-{key}.txt"
+                if key == 'vectors' and planet in run.append_from:
+                    window_start = parse_horizons_time(append_start_time(run, planet)).strftime('%Y%m%d%H%M')
+                    ho_file_name = f"{run.raw_dir}/ho-{fn}-{key}-{window_start}.txt"
+                try:
+                    with open(ho_file_name, 'w') as fh:
+                        for line in horizons_lines(run, planet, key):
+                            fh.write(line)
+                            fh.write("\n")
+                except IOError as e:
+                    print_error(f"Can't write to {ho_file_name}: {e}")
+                    return False
 
         return True
     except IOError as e:
         print_error(f"Failed to save fetched data: {e}")
         return False
 
-def save_orbit_data_json():
-    print_debug(f"Entering save_orbit_data_json")
-    print_debug(f"orbits_file: {orbits_file}")
+# Orbit JSON. By default every table is written column by column -- {"format": "columnar", "bodies": {planet:
+# {"elements": {field: [...]}, "vectors": {field: [...]}}}} -- with numbers rounded to json_significant_digits
+# and Julian dates kept to 1e-9 d. Columns are formatted and written a chunk at a time. --json-legacy writes
+# the old layout of one object per record instead; cy3.js reads both.
+
+json_legacy = False
+json_significant_digits = 10
+json_compression = []  # any of 'gz', 'br': also write <orbits_file>.json.gz / .json.br for static hosting
+JSON_CHUNK_VALUES = 65536
+JSON_JD_FIELDS = ('jdct', 'tp')  # Julian dates need more digits than the rest
+
+def format_json_numbers(values, fmt):
+    if np.isfinite(values).all():
+        return ",".join(map(fmt.__mod__, values.tolist()))
+    return ",".join(fmt % v if np.isfinite(v) else "null" for v in values.tolist())
+
+def write_json_column(fh, values, fmt):
+    fh.write("[")
+    for start in range(0, len(values), JSON_CHUNK_VALUES):
+        chunk = values[start:start + JSON_CHUNK_VALUES]
+        if values.dtype.kind in 'US':
+            text = ",".join(json.dumps(str(v)) for v in chunk.tolist())
+        else:
+            text = format_json_numbers(chunk, fmt)
+        fh.write(f"{',' if start else ''}{text}")
+    fh.write("]")
+
+def write_json_table(fh, table, digits):
+    # One table's columns as a JSON object; table is an OrbitTable or a structured array
+    number_format = f"%.{digits}g"
+    fields = table.dtype.names if isinstance(table, np.ndarray) else table.fields
+    fh.write("{")
+    for k, field in enumerate(fields):
+        fh.write(f"{',' if k else ''}\n      {json.dumps(field)}: ")
+        write_json_column(fh, table[field], "%.9f" if field in JSON_JD_FIELDS else number_format)
+    fh.write("\n    }")
+
+def write_orbits_json_columnar(run, fh, table_parts=None):
+    # table_parts maps (planet, table name) to a file already holding that table's JSON, see export_json_tables
+    fh.write('{"format": "columnar", "version": 1, "bodies": {')
+    for i, (planet, data) in enumerate(run.orbits.items()):
+        fh.write(f"{',' if i else ''}\n  {json.dumps(planet)}: {{")
+        sections = [name for name in ('elements', 'vectors') if name in data]
+        for j, name in enumerate(sections):
+            fh.write(f"{',' if j else ''}\n    {json.dumps(name)}: ")
+            if table_parts is not None:
+                with open(table_parts[planet, name]) as part:
+                    shutil.copyfileobj(part, fh, DOWNLOAD_CHUNK_BYTES)
+            else:
+                write_json_table(fh, data[name], json_significant_digits)
+        fh.write("\n  }")
+    fh.write("\n}}\n")
+
+def compress_file(path, formats):
+    # Writes path.gz and/or path.br next to path, streaming it through the compressors
+    status = True
+    for fmt in formats:
+        if fmt == 'br' and brotli is None:
+            print_error(f"The brotli module is not installed; not writing {path}.br")
+            status = False
+            continue
+        with open(path, 'rb') as src, open(f"{path}.{fmt}", 'wb') as dst:
+            if fmt == 'gz':
+                with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=9, mtime=0) as gz:
+                    shutil.copyfileobj(src, gz, DOWNLOAD_CHUNK_BYTES)
+            else:
+                compressor = brotli.Compressor(quality=11)
+                for block in iter(lambda: src.read(DOWNLOAD_CHUNK_BYTES), b""):
+                    dst.write(compressor.process(block))
+                dst.write(compressor.finish())
+        print_debug("Compressed %s to %s.%s", path, path, fmt)
+    return status
+
+def write_orbits_json(run, fh):
+    # Same layout as json.dump of the old dict-of-records structure, written one record at a time
+    fh.write("{")
+    for i, (planet, data) in enumerate(run.orbits.items()):
+        fh.write(f"{',' if i else ''}\n  {json.dumps(planet)}: {{")
+        sections = [name for name in ('elements', 'vectors') if name in data]
+        for j, name in enumerate(sections):
+            keyed = name == 'elements'  # elements are keyed by jdct, vectors are a plain list
+            fh.write(f"{',' if j else ''}\n    {json.dumps(name)}: {'{' if keyed else '['}")
+            for k, rec in enumerate(data[name].records()):
+                key = f"\"{rec['jdct']:.9f}\": " if keyed else ""
+                fh.write(f"{',' if k else ''}\n      {key}{json.dumps(rec)}")
+            fh.write(f"\n    {'}' if keyed else ']'}")
+        fh.write("\n  }")
+    fh.write("\n}\n")
+
+@profiled('write json', outputs=lambda run: [f"{run.orbits_file}.json{suffix}" for suffix in ("", ".gz", ".br")])
+def save_orbit_data_json(run):
+    print_debug("Entering save_orbit_data_json")
+    print_debug("orbits_file: %s", run.orbits_file)
     
     try:
         # Ensure the directory exists
-        os.makedirs(os.path.dirname(orbits_file), exist_ok=True)
+        os.makedirs(os.path.dirname(run.orbits_file), exist_ok=True)
         
-        with open(f"{orbits_file}.json", 'w') as fh:
-            json.dump(orbits, fh, indent=2)
+        with open(f"{run.orbits_file}.json", 'w') as fh:
+            if json_legacy:
+                write_orbits_json(run, fh)
+            elif use_cpu_pool(sum(name in data for data in run.orbits.values() for name in ('elements', 'vectors'))):
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(run.orbits_file) or ".") as parts_dir:
+                    write_orbits_json_columnar(run, fh, export_json_tables(run, parts_dir))
+            else:
+                write_orbits_json_columnar(run, fh)
         
-        print_debug(f"JSON data written to {orbits_file}.json")
+        print_debug("JSON data written to %s.json", run.orbits_file)
+        compress_file(f"{run.orbits_file}.json", json_compression)
         
         # Verify the file was created and has content
-        if os.path.exists(f"{orbits_file}.json") and os.path.getsize(f"{orbits_file}.json") > 0:
-            print_debug(f"File {orbits_file}.json exists and has content")
+        if os.path.exists(f"{run.orbits_file}.json") and os.path.getsize(f"{run.orbits_file}.json") > 0:
+            print_debug("File %s.json exists and has content", run.orbits_file)
         else:
-            print_error(f"File {orbits_file}.json either doesn't exist or is empty")
+            print_error(f"File {run.orbits_file}.json either doesn't exist or is empty")
         
         return True
     except IOError as e:
-        print_error(f"IOError when writing to {orbits_file}.json: {e}")
+        print_error(f"IOError when writing to {run.orbits_file}.json: {e}")
     except json.JSONEncodeError as e:
         print_error(f"JSON encoding error: {e}")
     except Exception as e:
@@ -335,194 +543,558 @@ def save_orbit_data_json():
     
     return False
 
-def save_orbit_data():
-    for planet in planets:
+@profiled('write text', outputs=lambda run: [f"{run.raw_dir}/ho-{filename_for_planet(planet)}-orbit.txt" for planet in run.planets])
+def save_orbit_data(run):
+    for planet in run.planets:
         fn = filename_for_planet(planet)
-        ho_file_name = f"{data_dir}/ho-{fn}-orbit.txt"
+        ho_file_name = f"{run.raw_dir}/ho-{fn}-orbit.txt"
         try:
             with open(ho_file_name, 'w') as fh:
-                elements = orbits[planet]['elements']
-                
-                # print_debug(f"Planet {planet} has elements at: {','.join(sorted(elements.keys()))}")
-                
-                for jdct in sorted(elements.keys()):
-                    print_elements(fh, elements[jdct])
+                for rec in run.orbits[planet]['elements'].records():
+                    print_elements(fh, rec)
                     fh.write("\n")
                 
                 fh.write("\n")
         except IOError as e:
             print_error(f"Can't write to {ho_file_name}: {e}")
 
-def fetch_horizons_data(planet, options):
-    table_type_map = {
-        'elements': ('ELEMENTS', 'elements_content'),
-        'vectors': ('VECTORS', 'vectors_content')
-    }
-    
+horizons_session = None
+horizons_session_lock = threading.Lock()
+fetch_executor = None
+
+def get_horizons_session():
+    # One keep-alive session shared by all fetch threads; its pool is sized to the concurrency cap
+    global horizons_session
+    with horizons_session_lock:
+        if horizons_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            horizons_session = session
+    return horizons_session
+
+def get_fetch_executor():
+    # All Horizons GETs go through this pool, so max_concurrency caps requests across every table and chunk
+    global fetch_executor
+    with horizons_session_lock:
+        if fetch_executor is None:
+            fetch_executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="horizons")
+    return fetch_executor
+
+def stream_horizons_response(response, path):
+    # Write the body to path line by line as it arrives; returns True if it held a complete $$SOE..$$EOE table
+    response.encoding = response.encoding or 'utf-8'
+    seen_soe = seen_eoe = False
+    with open(path, 'w') as fh:
+        for line in response.iter_lines(chunk_size=DOWNLOAD_CHUNK_BYTES, decode_unicode=True):
+            seen_soe = seen_soe or line.startswith('$$SOE')
+            seen_eoe = seen_eoe or (seen_soe and line.startswith('$$EOE'))
+            fh.write(line)
+            fh.write("\n")
+    return seen_soe and seen_eoe
+
+@profiled('fetch')
+def horizons_download(params, path):
+    # Stream one Horizons query into path, retrying the whole query on transient failures
+    session = get_horizons_session()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    attempt = 0
+    while True:
+        try:
+            with session.get(horizons_url, params=params, timeout=fetch_timeout_seconds, stream=True) as response:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()  # Raises an HTTPError for bad responses
+                    complete = stream_horizons_response(response, tmp_path)
+                    break
+                error = f"HTTP {response.status_code}"
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = str(e)
+
+        if attempt >= fetch_retries:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise requests.RequestException(f"giving up after {attempt + 1} attempts: {error}")
+
+        delay = fetch_backoff_seconds * (2 ** attempt)
+        attempt += 1
+        print_debug("Request failed (%s), retry %s/%s in %.1fs", error, attempt, fetch_retries, delay)
+        time.sleep(delay)
+
+    # Horizons reports errors as plain text in a 200 response; only complete tables enter the cache
+    if not complete:
+        with open(tmp_path, 'r') as fh:
+            message = ' '.join(fh.read(2000).split())
+        os.remove(tmp_path)
+        raise ValueError(f"no $$SOE/$$EOE table in response: {message}")
+    os.replace(tmp_path, path)
+    profile_record('fetch', nbytes=os.path.getsize(path))
+
+HORIZONS_TIME_FORMAT = "%Y-%m-%d %H:%M"
+STEP_UNIT_SECONDS = {'s': 1, 'm': 60, 'min': 60, 'h': 3600, 'd': 86400}
+
+def parse_horizons_time(t):
+    for fmt in (HORIZONS_TIME_FORMAT, HORIZONS_TIME_FORMAT + ":%S"):
+        try:
+            return datetime.strptime(t, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognized Horizons time: {t}")
+
+def format_horizons_time(t):
+    return t.strftime(HORIZONS_TIME_FORMAT + (":%S" if t.second else ""))
+
+def parse_step_size(step):
+    # Returns the step as a timedelta, or None for a unitless step (Horizons then treats it as an interval count)
+    count, _, unit = str(step).strip().partition(' ')
+    if not unit:
+        return None
+    return timedelta(seconds=float(count) * STEP_UNIT_SECONDS[unit.strip()])
+
+def split_time_window(start_time, stop_time, step):
+    step_delta = parse_step_size(step)
+    if chunk_days <= 0 or step_delta is None:
+        return [(start_time, stop_time)]
+
+    # Chunks are a whole number of steps long, so every chunk samples the same time grid as one big query
+    steps_per_chunk = max(1, int(timedelta(days=chunk_days) / step_delta))
+    chunk = step_delta * steps_per_chunk
+
+    start = parse_horizons_time(start_time)
+    stop = parse_horizons_time(stop_time)
+    windows = []
+    t = start
+    while t < stop:
+        t_next = min(t + chunk, stop)
+        windows.append((format_horizons_time(t), format_horizons_time(t_next)))
+        t = t_next
+    return windows or [(start_time, stop_time)]
+
+def plan_fetch_schedule(start_time, stop_time, default_step, schedule):
+    # The fewest (start, stop, step) ranges that sample [start_time, stop_time] at default_step except inside
+    # the windows of schedule, a list of (start, stop, step). Where windows overlap the finest step wins, and
+    # neighbouring pieces with the same step become one range. Shared boundary epochs are dropped when the
+    # chunks are stitched, so the ranges read back as one time-ordered series.
+    start, stop = parse_horizons_time(start_time), parse_horizons_time(stop_time)
+    segments = [(start, stop, default_step)]
+    for window_start, window_stop, step in schedule:
+        segments.append((max(parse_horizons_time(window_start), start), min(parse_horizons_time(window_stop), stop), step))
+    segments = [segment for segment in segments if segment[0] < segment[1]]
+    for _, _, step in segments:
+        if parse_step_size(step) is None:
+            raise ValueError(f"Step {step} has no unit (s, m, h or d)")
+
+    plan = []
+    boundaries = sorted({t for segment in segments for t in segment[:2]})
+    for a, b in zip(boundaries, boundaries[1:]):
+        step = min((step for s0, s1, step in segments if s0 <= a and b <= s1), key=parse_step_size)
+        if plan and parse_step_size(plan[-1][2]) == parse_step_size(step):
+            plan[-1] = (plan[-1][0], b, plan[-1][2])
+        else:
+            plan.append((a, b, step))
+    if not plan:
+        return [(start_time, stop_time, default_step)]
+    return [(format_horizons_time(a), format_horizons_time(b), step) for a, b, step in plan]
+
+def iter_stitched_lines(paths):
+    # Lines of one response spliced from the chunk files in paths: the header of the first chunk, the
+    # $$SOE..$$EOE rows of all chunks, the footer of the last. Neighbouring chunks share their boundary
+    # epoch, so a chunk's leading rows that are not later than the previous chunk's last row are dropped.
+    last_jdct = None
+    for i, path in enumerate(paths):
+        first, last = i == 0, i == len(paths) - 1
+        section = 'header'
+        last_row = None
+        with open(path, 'r') as fh:
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if section == 'header':
+                    if line.startswith('$$SOE'):
+                        section = 'rows'
+                    if first:
+                        yield line
+                elif section == 'rows':
+                    if line.startswith('$$EOE'):
+                        section = 'footer'
+                        if last:
+                            yield line
+                    elif line.strip():
+                        if last_jdct is not None and last_row is None and float(line.split(',', 1)[0]) <= last_jdct:
+                            continue
+                        last_row = line
+                        yield line
+                elif last:
+                    yield line
+
+        if section != 'footer':
+            raise ValueError(f"Chunk {i + 1} of {len(paths)} ({path}) has no $$SOE/$$EOE block")
+        if last_row is not None:
+            last_jdct = float(last_row.split(',', 1)[0])
+
+def horizons_lines(run, planet, key):
+    return iter_stitched_lines(run.orbits_raw[planet][f"{key}_chunks"])
+
+def horizons_cache_path(params):
+    # Key on every query parameter (body, center, table type, window, step, epoch, format), not just the day
+    canonical = json.dumps(sorted(params.items()))
+    key = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.txt")
+
+@profiled('evict cache')
+def evict_horizons_cache():
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.txt'):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        print_debug("Evicted %s from the Horizons cache", path)
+
+def horizons_get_cached(params):
+    # Returns the path of the cached response, downloading it first if needed
+    path = horizons_cache_path(params)
+    if os.path.exists(path):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        os.utime(path)  # the mtime doubles as the last access time for LRU eviction
+        print_debug("Cache hit for %s", params)
+        if profiling:
+            profile_record('cache load', time.perf_counter() - wall, time.thread_time() - cpu, 1, nbytes=os.path.getsize(path))
+        return path
+
+    if use_cached_data:
+        raise requests.RequestException(f"query not in cache and --use-cache forbids fetching: {params}")
+
+    horizons_download(params, path)
+    return path
+
+HORIZONS_TABLE_TYPES = {
+    'elements': ('ELEMENTS', 'elements_chunks'),
+    'vectors': ('VECTORS', 'vectors_chunks')
+}
+
+def horizons_chunk_params(run, planet, options):
+    # The Horizons queries, one per time chunk, that make up one table of a run
     try:
-        table_type, content_key = table_type_map[options['table_type']]
+        table_type, _ = HORIZONS_TABLE_TYPES[options['table_type']]
     except KeyError:
         raise ValueError(f"Invalid table_type: {options['table_type']}")
 
-    base_url = "https://ssd.jpl.nasa.gov/horizons_batch.cgi"
     params = {
         'batch': '1',
         'COMMAND': f"'{planet_codes[planet]}'",
         'TABLE_TYPE': f"'{table_type}'",
-        'CENTER': f"'{center}'",
+        'CENTER': f"'{options.get('center', run.center)}'",
         'CSV_FORMAT': "'YES'"
     }
     
     if options.get('range'):
-        params.update({
-            'START_TIME': f"'{options['start_time']}'",
-            'STOP_TIME': f"'{options['stop_time']}'",
-            'STEP_SIZE': f"'{options['step_size']}'"
-        })
+        plan = plan_fetch_schedule(options['start_time'], options['stop_time'], options['step_size'], options.get('schedule', []))
+        return [dict(params, **{
+            'START_TIME': f"'{start_time}'",
+            'STOP_TIME': f"'{stop_time}'",
+            'STEP_SIZE': f"'{step}'"
+        }) for range_start, range_stop, step in plan for start_time, stop_time in split_time_window(range_start, range_stop, step)]
     else:
-        params['TLIST'] = f"{jd}'"
+        params['TLIST'] = f"{run.jd}'"
+        return [params]
 
-    print_debug(f"url = {base_url}")
-    print_debug(f"params = {params}")
+def fetch_horizons_data(run, planet, options):
+    try:
+        chunk_params = horizons_chunk_params(run, planet, options)
+    except ValueError as e:
+        print_error(str(e))
+        return False
+    chunks_key = options.get('chunks_key', HORIZONS_TABLE_TYPES[options['table_type']][1])
 
+    print_debug("url = %s", horizons_url)
+    print_debug("params = %s (%s chunks)", chunk_params[0], len(chunk_params))
+
+    # Each chunk is cached and retried on its own, so a rerun or a failure only fetches the missing windows
+    futures = [get_fetch_executor().submit(horizons_get_cached, p) for p in chunk_params]
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()  # Raises an HTTPError for bad responses
-        
-        orbits_raw.setdefault(planet, {})[content_key] = response.text
+        run.orbits_raw.setdefault(planet, {})[chunks_key] = [future.result() for future in futures]
         return True
     except requests.RequestException as e:
+        for future in futures:
+            future.cancel()
         print_error(f"HTTP request failed: {str(e)}")
         return False
+    except ValueError as e:
+        print_error(f"Malformed Horizons response for {planet}: {e}")
+        return False
 
-def fetch_elements(planet):
-    print_debug(f"Fetching elements for planet {planet} ...")
-    status = fetch_horizons_data(planet, {'table_type': 'elements'})
-    print_debug(f"Fetching elements for planet {planet} completed.")
+def fetch_elements(run, planet):
+    print_debug("Fetching elements for planet %s ...", planet)
+    status = fetch_horizons_data(run, planet, {'table_type': 'elements'})
+    print_debug("Fetching elements for planet %s completed.", planet)
     return status
 
-def fetch_vectors(planet):
-    print_debug(f"Fetching vectors for planet {planet} ...")
-    status = fetch_horizons_data(planet, {'table_type': 'vectors'})
-    print_debug(f"Fetching vectors for planet {planet} completed.")
+def fetch_vectors(run, planet):
+    print_debug("Fetching vectors for planet %s ...", planet)
+    status = fetch_horizons_data(run, planet, {'table_type': 'vectors'})
+    print_debug("Fetching vectors for planet %s completed.", planet)
     return status    
 
-import os
-
-def load_cached_data():
-    ret_status = True
-
-    print_debug("Entering load_cached_data")
-
-    cache_file = f"{data_dir}/momcache.txt"
-    try:
-        with open(cache_file, 'r') as cache:
-            for line in cache:
-                line = line.strip()
-                if line.startswith('jd'):
-                    global jd
-                    jd = float(line.split('=')[1].strip())
-                    print_debug(f"jd = {jd}")
-
-        for planet in planets:
-            for key in ['elements', 'vectors']:
-                pn = filename_for_planet(planet)
-                fn = f"{data_dir}/ho-{pn}-{key}.txt"
-
-                if os.path.isfile(fn) and os.access(fn, os.R_OK):
-                    try:
-                        with open(fn, 'r') as f:
-                            content = f.read()
-                            if planet not in orbits_raw:
-                                orbits_raw[planet] = {}
-                            orbits_raw[planet][f"{key}_content"] = content
-                    except IOError as e:
-                        print_error(f"Unable to open {fn}: {e}")
-                        ret_status = False
-                        break
-                else:
-                    print_debug(f"File {fn} not found or not readable")
-
-    except IOError as e:
-        print_error(f"Unable to open {cache_file}: {e}")
-        ret_status = False
-
-    print_debug("Leaving load_cached_data")
-    return ret_status
-
-def parse_horizons_elements(code, planet):
-    print_debug(f"Entering parse_horizons_elements: code = {code}, planet = {planet}")
-
-    parse = False
-    key = 'elements_content' if code == 'elements' else 'vectors_content'
-    lines = orbits_raw[planet][key].split('\n')
+def fetch_jobs(run):
+    # The (planet, options) pairs to fetch for a run: elements at the start epoch and vectors over the window,
+    # or with --append only from the last archived epoch on
+    jobs = []
+    vectors_options = {}
+    for planet in run.planets:
+        jobs.append((planet, {'table_type': 'elements'}))
+        vectors_options[planet] = {
+            'table_type': 'vectors',
+            'range': True,
+            'start_time': append_start_time(run, planet) or get_horizons_start_time(run, planet),
+            'stop_time': get_horizons_stop_time(run, planet),
+            'step_size': run.step_size,
+            'schedule': run.schedule
+        }
+    if derives_selenocentric(run):
+        return jobs + selenocentric_fetch_jobs(run, vectors_options)
+    return jobs + list(vectors_options.items())
+
+def fetch_all_horizons_data(run, jobs):
+    # jobs is a list of (planet, options) pairs as accepted by fetch_horizons_data
+    # Each job only waits on its chunk requests, which are throttled by the shared fetch executor
+    print_debug("Fetching %s Horizons tables with up to %s requests in flight", len(jobs), max_concurrency)
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+        statuses = list(executor.map(lambda job: fetch_horizons_data(run, *job), jobs))
+
+    for (planet, options), status in zip(jobs, statuses):
+        if not status:
+            print_error(f"Failed to fetch {options['table_type']} for {planet}")
+    return all(statuses)
+
+def prefetch_horizons_data(runs):
+    # Fetches the union of the Horizons queries of several runs into the cache, each distinct query once,
+    # so that the runs themselves then only read cached responses
+    unique = {}
+    total = 0
+    for run in runs:
+        for planet, options in fetch_jobs(run):
+            try:
+                chunk_params = horizons_chunk_params(run, planet, options)
+            except ValueError as e:
+                print_error(f"Can't plan the {options['table_type']} queries for {planet} in {run.phase}: {e}")
+                return False
+            for params in chunk_params:
+                unique.setdefault(horizons_cache_path(params), params)
+                total += 1
+    print_debug("Fetch plan for %s: %s queries, %s distinct", ', '.join(run.phase for run in runs), total, len(unique))
+
+    futures = [get_fetch_executor().submit(horizons_get_cached, params) for params in unique.values()]
+    status = True
+    for future in futures:
+        try:
+            future.result()
+        except requests.RequestException as e:
+            print_error(f"HTTP request failed: {str(e)}")
+            status = False
+        except ValueError as e:
+            print_error(f"Malformed Horizons response: {e}")
+            status = False
+    return status
 
-    count = 0
+ELEMENT_FIELDS = ['jdct', 'date', 'ec', 'qr', 'in', 'om', 'w', 'tp', 'n', 'ma', 'ta', 'a', 'ad', 'pr']
+VECTOR_FIELDS = ['jdct', 'x', 'y', 'z', 'vx', 'vy', 'vz']
+
+ELEMENTS_DTYPE = np.dtype([(f, 'U32' if f == 'date' else 'f8') for f in ELEMENT_FIELDS])
+VECTORS_DTYPE = np.dtype([(f, 'f8') for f in VECTOR_FIELDS])
+ELEMENTS_NPY_DTYPE = np.dtype([(f, 'f8') for f in ELEMENT_FIELDS if f != 'date'])
+
+class OrbitTable:
+    # One body's elements or vectors held column-wise: a contiguous array per field, rows sorted by jdct
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.sort_by_time()
+
+    @classmethod
+    def from_array(cls, table):
+        return cls({name: np.ascontiguousarray(table[name]) for name in table.dtype.names})
+
+    def __len__(self):
+        return len(self.columns['jdct'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    def sort_by_time(self):
+        jdct = self.columns['jdct']
+        if len(jdct) > 1 and np.any(jdct[1:] < jdct[:-1]):
+            order = np.argsort(jdct, kind='stable')
+            self.columns = {name: column[order] for name, column in self.columns.items()}
+
+    def merge(self, other):
+        # Rows of other win over rows of self at the same epoch
+        columns = {name: np.concatenate([self.columns[name], other.columns[name]]) for name in self.columns}
+        order = np.argsort(columns['jdct'], kind='stable')
+        jdct = columns['jdct'][order]
+        keep = np.append(jdct[1:] != jdct[:-1], True)  # last row of every run of equal epochs
+        return OrbitTable({name: column[order][keep] for name, column in columns.items()})
+
+    def row_slice(self, start, stop):
+        return OrbitTable({name: column[start:stop] for name, column in self.columns.items()})
+
+    def time_slice(self, start_jd, stop_jd):
+        lo = np.searchsorted(self.columns['jdct'], start_jd, side='left')
+        hi = np.searchsorted(self.columns['jdct'], stop_jd, side='right')
+        return self.row_slice(lo, hi)
+
+    def to_array(self, dtype):
+        table = np.empty(len(self), dtype=dtype)
+        for name in dtype.names:
+            table[name] = self.columns[name]
+        return table
+
+    @classmethod
+    def from_states(cls, jdct, position, velocity):
+        # Inverse of state_arrays: stores the velocity with vx and vy swapped like the parser does
+        return cls({'jdct': jdct,
+                    'x': position[:, 0], 'y': position[:, 1], 'z': position[:, 2],
+                    'vx': velocity[:, 1], 'vy': velocity[:, 0], 'vz': velocity[:, 2]})
+
+    def state_arrays(self):
+        # (n, 3) position and velocity arrays of a vectors table, built once. The stored vx and vy columns are
+        # Horizons' VY and VX (see parse_horizons_table); the velocity returned here is the true one.
+        if not hasattr(self, '_state_arrays'):
+            position = np.column_stack([self.columns['x'], self.columns['y'], self.columns['z']])
+            velocity = np.column_stack([self.columns['vy'], self.columns['vx'], self.columns['vz']])
+            self._state_arrays = (position, velocity)
+        return self._state_arrays
+
+    def uniform_step(self):
+        # The sampling step in days if the rows are evenly spaced in time, else None: every epoch lies within 1% of
+        # a step of its place on the grid jdct[0] + k * step. That absorbs Horizons' rounding of JDTDB to 9
+        # decimals, and interpolate_vectors corrects the row it computes from the grid.
+        if not hasattr(self, '_uniform_step'):
+            jdct = self.columns['jdct']
+            step = (jdct[-1] - jdct[0]) / (len(jdct) - 1) if len(jdct) > 1 else 0.0
+            uniform = step > 0 and np.max(np.abs(jdct - (jdct[0] + np.arange(len(jdct)) * step))) < 0.01 * step
+            self._uniform_step = float(step) if uniform else None
+        return self._uniform_step
+
+    def records(self):
+        names = self.fields
+        for row in zip(*(self.columns[name].tolist() for name in names)):
+            yield dict(zip(names, row))
+
+# Number of CSV fields per row: JDTDB, Calendar Date, then the table's own columns
+HORIZONS_FIELD_COUNTS = {'elements': 14, 'vectors': 11}
+
+PARSE_BATCH_ROWS = 65536  # rows decoded per np.loadtxt call when parsing a stream
+
+def iter_soe_rows(lines):
+    # The non-blank lines between $$SOE and $$EOE of a response given as an iterable of lines
+    lines = iter(lines)
     for line in lines:
         if line.startswith('$$SOE'):
-            parse = True
-            continue
+            break
+    for line in lines:
         if line.startswith('$$EOE'):
-            parse = False
-            continue
-        if parse:
-            count += 1
-            if code == 'elements':
-                # Use regex to split the line, handling potential quoted fields
-                fields = re.findall(r'(?:[^,"]|"(?:\\.|[^"])*")+', line)
-                fields = [field.strip().strip('"') for field in fields]  # Remove leading/trailing spaces and quotes
-                
-                if len(fields) != 14:
-                    print_error(f"Unexpected number of fields in line: {line}")
-                    continue
-
-                jdct, date, ec, qr, in_, om, w, tp, n, ma, ta, a, ad, pr = fields
-                
-                rec = {
-                    'jdct': jdct, 'date': date, 'ec': ec, 'qr': qr, 'in': in_, 'om': om,
-                    'w': w, 'tp': tp, 'n': n, 'ma': ma, 'ta': ta, 'a': a, 'ad': ad, 'pr': pr
-                }
-
-                if planet not in orbits:
-                    orbits[planet] = {'elements': {}}
-                if 'elements' not in orbits[planet]:
-                    orbits[planet]['elements'] = {}
-                if jdct in orbits[planet]['elements']:
-                    # print_debug(f"Merging elements for planet={planet}, jdct={jdct}")
-                    orbits[planet]['elements'][jdct].update(rec)
-                else:
-                    # print_debug(f"Adding elements for planet={planet}, jdct={jdct}")
-                    orbits[planet]['elements'][jdct] = rec
-
-            elif code == 'vectors':
-                # Use regex to split the line, handling potential quoted fields
-                fields = re.findall(r'(?:[^,"]|"(?:\\.|[^"])*")+', line)
-                fields = [field.strip().strip('"') for field in fields]  # Remove leading/trailing spaces and quotes
-                
-                if len(fields) != 11:
-                    print_error(f"Unexpected number of fields in line: {line}")
-                    continue
+            return
+        if line.strip():
+            yield line
+
+def count_csv_fields(line):
+    # Horizons terminates every CSV row with a comma
+    return line.rstrip().rstrip(',').count(',') + 1
+
+def load_horizons_rows(lines, code):
+    nfields = HORIZONS_FIELD_COUNTS[code]
+    dtype = ELEMENTS_DTYPE if code == 'elements' else VECTORS_DTYPE
+    if not lines:
+        return np.empty(0, dtype=dtype)
+
+    if code == 'elements':
+        table = np.loadtxt(lines, delimiter=',', quotechar='"', usecols=range(nfields), dtype=dtype, ndmin=1)
+        table['date'] = np.char.strip(table['date'])
+        return table
+
+    # Columns: JDTDB, X, Y, Z, VX, VY, VZ (the calendar date and LT, RG, RR are not kept)
+    columns = np.loadtxt(lines, delimiter=',', quotechar='"', usecols=(0, 2, 3, 4, 5, 6, 7), ndmin=2)
+    table = np.empty(len(columns), dtype=dtype)
+    table['jdct'] = columns[:, 0]
+    table['x'] = columns[:, 1]
+    table['y'] = columns[:, 2]
+    table['z'] = columns[:, 3]
+    table['vx'] = columns[:, 5]  # Note: vx and vy are swapped as in original
+    table['vy'] = columns[:, 4]
+    table['vz'] = columns[:, 6]
+    return table
+
+def valid_horizons_row(line, code):
+    if count_csv_fields(line) != HORIZONS_FIELD_COUNTS[code]:
+        print_error(f"Unexpected number of fields in line: {line}")
+        return False
+    try:
+        load_horizons_rows([line], code)
+        return True
+    except ValueError as e:
+        print_error(f"Can't decode line: {line} ({e})")
+        return False
 
-                jdct, date, x, y, z, vx, vy, vz, lt, rg, rr = fields
-                
-                rec = {
-                    'jdct': jdct,
-                    'x': x, 'y': y, 'z': z,
-                    'vx': vy, 'vy': vx, 'vz': vz  # Note: vx and vy are swapped as in original
-                }
-
-                if planet not in orbits:
-                    orbits[planet] = {'vectors': []}
-                if 'vectors' not in orbits[planet]:
-                    orbits[planet]['vectors'] = []
-                
-                orbits[planet]['vectors'].append(rec)
+def decode_horizons_rows(lines, code):
+    nfields = HORIZONS_FIELD_COUNTS[code]
 
-    print_debug(f"Found {count} {code} records for planet {planet}")
+    # Validate the field count in bulk and only fall back to checking line by line when it is off. The totals
+    # can still balance out -- a short row and a long one -- or a field may not be a number, so a batch that
+    # fails to decode is checked line by line as well.
+    ncommas = ''.join(lines).count(',')
+    if ncommas not in (nfields * len(lines), (nfields - 1) * len(lines)):
+        lines = [line for line in lines if valid_horizons_row(line, code)]
+    try:
+        return load_horizons_rows(lines, code)
+    except ValueError:
+        return load_horizons_rows([line for line in lines if valid_horizons_row(line, code)], code)
+
+def parse_horizons_stream(lines, code):
+    # Decode a response arriving as an iterable of lines in fixed-size batches, so only one batch of text
+    # is held at a time
+    batches = []
+    batch = []
+    for line in iter_soe_rows(lines):
+        batch.append(line)
+        if len(batch) == PARSE_BATCH_ROWS:
+            batches.append(decode_horizons_rows(batch, code))
+            batch = []
+    if batch or not batches:
+        batches.append(decode_horizons_rows(batch, code))
+    return batches[0] if len(batches) == 1 else np.concatenate(batches)
+
+def parse_horizons_table(content, code):
+    return parse_horizons_stream(content.splitlines(), code)
+
+def store_parsed_table(run, code, planet, table):
+    body = run.orbits.setdefault(planet, {})
+    body[code] = body[code].merge(table) if code in body else table
+    return table
+
+@profiled('parse')
+def parse_horizons_elements(run, code, planet):
+    print_debug("Entering parse_horizons_elements: code = %s, planet = %s", code, planet)
+
+    table = store_parsed_table(run, code, planet, OrbitTable.from_array(parse_horizons_stream(horizons_lines(run, planet, code), code)))
+
+    print_debug("Found %s %s records for planet %s", len(table), code, planet)
+    if profiling:
+        profile_record('parse', rows=len(table), nbytes=sum(path_size(path) for path in run.orbits_raw[planet][f"{code}_chunks"]))
     print_debug("Leaving parse_horizons_elements")
 
-    import sys
-
 def print_elements(fh, rec):
     fh.write(f"JDCT = {rec['jdct']}\n")
     fh.write(f"Date = {rec['date']}\n")
@@ -541,43 +1113,44 @@ def print_elements(fh, rec):
     # fh.write(f"X = {rec['x']}\n")
     # fh.write(f"Y = {rec['y']}\n")
 
-def save_orbit_data_npy():
-    print_debug(f"Entering save_orbit_data_npy")
+# NPY archive: the structured elements and vectors arrays of every body, back to back in one file at 64-byte
+# aligned offsets, plus a small JSON index of (body, table, dtype, offset, rows). Each array can be mapped with
+# np.memmap without reading the rest, and sliced to a time window by binary search on jdct.
+
+ARCHIVE_ALIGNMENT = 64
+ARCHIVE_WRITE_ROWS = 65536  # rows converted to the on-disk layout at a time
+
+def archive_files(base):
+    return f"{base}_archive.bin", f"{base}_archive.json"
+
+@profiled('write npy', outputs=lambda run: list(archive_files(run.archive_base)))
+def save_orbit_data_npy(run):
+    print_debug("Entering save_orbit_data_npy")
     
+    archive_file, index_file = archive_files(run.archive_base)
+    index = {'version': 1, 'file': os.path.basename(archive_file), 'entries': []}
     try:
         # Ensure the directory exists
-        npy_dir = os.path.dirname(orbits_file)
+        npy_dir = os.path.dirname(run.archive_base)
         os.makedirs(npy_dir, exist_ok=True)
         
-        for planet, data in orbits.items():
-            elements_file = f"{orbits_file}_elements.npy"
-            vectors_file = f"{orbits_file}_vectors.npy"
-            
-            # Save elements data
-            if 'elements' in data:
-                elements_array = np.array([(float(e['jdct']), float(e['ec']), float(e['qr']), float(e['in']), 
-                                            float(e['om']), float(e['w']), float(e['tp']), float(e['n']), 
-                                            float(e['ma']), float(e['ta']), float(e['a']), float(e['ad']), 
-                                            float(e['pr'])) 
-                                           for e in data['elements'].values()],
-                                          dtype=[('jdct', 'f8'), ('ec', 'f8'), ('qr', 'f8'), ('in', 'f8'),
-                                                 ('om', 'f8'), ('w', 'f8'), ('tp', 'f8'), ('n', 'f8'),
-                                                 ('ma', 'f8'), ('ta', 'f8'), ('a', 'f8'), ('ad', 'f8'),
-                                                 ('pr', 'f8')])
-                np.save(elements_file, elements_array)
-                print_debug(f"Elements data for {planet} saved to {elements_file}")
-            
-            # Save vectors data
-            if 'vectors' in data:
-                vectors_array = np.array([(float(v['jdct']), float(v['x']), float(v['y']), float(v['z']),
-                                           float(v['vx']), float(v['vy']), float(v['vz']))
-                                          for v in data['vectors']],
-                                         dtype=[('jdct', 'f8'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
-                                                ('vx', 'f8'), ('vy', 'f8'), ('vz', 'f8')])
-                np.save(vectors_file, vectors_array)
-                print_debug(f"Vectors data for {planet} saved to {vectors_file}")
+        with open(archive_file, 'wb') as fh:
+            for planet, data in run.orbits.items():
+                for table_name, dtype in (('elements', ELEMENTS_NPY_DTYPE), ('vectors', VECTORS_DTYPE)):
+                    if table_name not in data:
+                        continue
+                    table = data[table_name]
+                    fh.write(b"\0" * (-fh.tell() % ARCHIVE_ALIGNMENT))
+                    index['entries'].append({'body': planet, 'table': table_name, 'dtype': dtype.descr,
+                                             'offset': fh.tell(), 'rows': len(table)})
+                    for start in range(0, len(table), ARCHIVE_WRITE_ROWS):
+                        fh.write(table.row_slice(start, start + ARCHIVE_WRITE_ROWS).to_array(dtype).tobytes())
+                    print_debug("%s data for %s saved to %s", table_name.capitalize(), planet, archive_file)
+
+        with open(index_file, 'w') as fh:
+            json.dump(index, fh, indent=2)
         
-        print_debug(f"NPY data written to {npy_dir}")
+        print_debug("NPY data written to %s", npy_dir)
         return True
     except IOError as e:
         print_error(f"IOError when writing NPY files: {e}")
@@ -588,21 +1161,1712 @@ def save_orbit_data_npy():
     
     return False
 
+class ArchiveSegments:
+    # A table that --append extended, stored as several segments in time order: the memmaps of the segments
+    # and the jdct bounds of each. Slicing reads only the segments that the rows fall in.
+
+    def __init__(self, segments):
+        self.segments = [segment for segment in segments if len(segment)] or segments[:1]
+        self.dtype = self.segments[0].dtype
+        self.offsets = np.cumsum([0] + [len(segment) for segment in self.segments])
+        self.first_jd = [float(segment['jdct'][0]) for segment in self.segments if len(segment)]
+        self.last_jd = [float(segment['jdct'][-1]) for segment in self.segments if len(segment)]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        # A field reads the whole column; a slice only the rows in it
+        if isinstance(key, str):
+            return np.concatenate([segment[key] for segment in self.segments])
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("ArchiveSegments supports field names and contiguous row slices")
+        start, stop, _ = key.indices(len(self))
+        parts = [segment[max(start - lo, 0):stop - lo]
+                 for segment, lo, hi in zip(self.segments, self.offsets[:-1], self.offsets[1:]) if lo < stop and start < hi]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts) if parts else self.segments[0][:0]
+
+    def time_window(self, start_jd, stop_jd):
+        lo = bisect.bisect_left(self.last_jd, start_jd)  # first segment that reaches start_jd
+        hi = bisect.bisect_right(self.first_jd, stop_jd)  # segments before this one start by stop_jd
+        if lo >= hi:
+            return self.segments[0][:0]
+        first = self.offsets[lo] + bisect.bisect_left(self.segments[lo]['jdct'], start_jd)
+        last = self.offsets[hi - 1] + bisect.bisect_right(self.segments[hi - 1]['jdct'], stop_jd)
+        return self[int(first):int(last)]
+
+def open_orbit_archive(index_file):
+    # Returns {planet: {table: read-only memmap of the structured array}}; nothing is read until sliced.
+    # A table that --append extended is stored as several segments and comes back as ArchiveSegments.
+    with open(index_file, 'r') as fh:
+        index = json.load(fh)
+    archive_file = os.path.join(os.path.dirname(index_file), index['file'])
+
+    segments = {}
+    for entry in index['entries']:
+        dtype = np.dtype([tuple(field) for field in entry['dtype']])
+        if entry['rows'] == 0:
+            array = np.empty(0, dtype=dtype)
+        else:
+            array = np.memmap(archive_file, dtype=dtype, mode='r', offset=entry['offset'], shape=(entry['rows'],))
+        segments.setdefault(entry['body'], {}).setdefault(entry['table'], []).append(array)
+
+    return {planet: {table: arrays[0] if len(arrays) == 1 else ArchiveSegments(arrays) for table, arrays in tables.items()}
+            for planet, tables in segments.items()}
+
+def archive_time_window(array, start_jd, stop_jd):
+    # Rows with start_jd <= jdct <= stop_jd; the binary search touches O(log n) rows of the mapping
+    if isinstance(array, ArchiveSegments):
+        return array.time_window(start_jd, stop_jd)
+    jdct = array['jdct']
+    lo = bisect.bisect_left(jdct, start_jd)
+    hi = bisect.bisect_right(jdct, stop_jd)
+    return array[lo:hi]
+
+# Append mode: for a mission whose ephemerides keep growing, --append reads the last archived vectors epoch
+# of every body, fetches only from that epoch on, checks that the overlapping samples agree with the archived
+# ones and adds the new rows to the archive as extra segments. Of the archive only the overlapping tail is
+# read. The other outputs are written for the new rows only, as the next segment <orbits_file>-<n> listed in
+# <orbits_file>_segments.json, which the viewer loads after <orbits_file>.json. The work is proportional to
+# the new data, not to the mission so far.
+
+append_mode = False
+append_tolerance_km = 1e-3  # largest position difference accepted where the new rows overlap the archive
+
+def jd_to_datetime(jd):
+    return datetime(1970, 1, 1) + timedelta(seconds=round((jd - 2440587.5) * 86400))
+
+@profiled('load archive')
+def load_archive_for_append(run):
+    _, index_file = archive_files(run.archive_base)
+    if not os.path.exists(index_file):
+        print_debug("No archive at %s, fetching the whole window", index_file)
+        return True
+
+    try:
+        archive = open_orbit_archive(index_file)
+    except (IOError, ValueError, KeyError) as e:
+        print_error(f"Can't read the archive {index_file}: {e}")
+        return False
+
+    for planet in run.planets:
+        vectors = archive.get(planet, {}).get('vectors')
+        if vectors is None or len(vectors) == 0:
+            continue
+        run.archived[planet] = vectors  # still mapped; append_archived_vectors only reads the tail
+        run.append_from[planet] = float(vectors[len(vectors) - 1:]['jdct'][0])
+        print_debug("Archive has %s vectors for %s up to JD %.9f", len(vectors), planet, run.append_from[planet])
+    return True
+
+def append_start_time(run, planet):
+    # Start of the vectors query for planet with --append: the last archived epoch, or one step before the stop
+    # time if the archive already reaches it, so that the query always overlaps the archive. None without --append.
+    if planet not in run.append_from:
+        return None
+    start = jd_to_datetime(run.append_from[planet])
+    stop_time = get_horizons_stop_time(run, planet)
+    _, _, last_step = plan_fetch_schedule(get_horizons_start_time(run, planet), stop_time, run.step_size, run.schedule)[-1]
+    return format_horizons_time(min(start, parse_horizons_time(stop_time) - parse_step_size(last_step)))
+
+def append_archived_vectors(run):
+    # Checks the fetched rows that overlap the archive against its tail and puts the tail in their place; the
+    # last archived sample stays in front of the new rows so that apsides and burns across the seam are found
+    for planet, archived in run.archived.items():
+        fetched = run.orbits[planet]['vectors']
+        overlap = fetched.time_slice(-np.inf, run.append_from[planet])
+        tail = archive_time_window(archived, overlap['jdct'][0], run.append_from[planet]) if len(overlap) else archived[:0]
+        tail = OrbitTable({name: np.array(tail[name]) for name in tail.dtype.names})
+        rows = np.searchsorted(tail['jdct'], overlap['jdct'])
+        rows = rows[(rows < len(tail)) & (tail['jdct'][np.minimum(rows, len(tail) - 1)] == overlap['jdct'])]
+        if len(overlap) == 0 or len(rows) != len(overlap):
+            print_error(f"Fetched vectors for {planet} don't overlap the archive at JD {run.append_from[planet]:.9f}; rerun without --append")
+            return False
+
+        position, _ = overlap.state_arrays()
+        error = np.max(np.linalg.norm(position - tail.state_arrays()[0][rows], axis=1))
+        if error > append_tolerance_km:
+            print_error(f"Fetched vectors for {planet} differ from the archive by {error:.6f} km at the overlap "
+                        f"(tolerance {append_tolerance_km} km); the ephemeris was revised, rerun without --append")
+            return False
+
+        run.orbits[planet]['vectors'] = fetched.merge(tail)
+        print_debug("Fetched %s new vectors for %s; overlap differs by %.6f km", len(fetched) - len(overlap), planet, error)
+    return True
+
+def segments_file(base):
+    return f"{base}_segments.json"
+
+def start_append_segment(run):
+    # Cuts the vectors, derived quantities, element series and events of every archived body to the epochs after
+    # its last archived one and points run.orbits_file at the next segment. Returns False if nothing is new.
+    for planet, after in run.append_from.items():
+        first = np.nextafter(after, np.inf)
+        run.orbits[planet]['vectors'] = run.orbits[planet]['vectors'].time_slice(first, np.inf)
+        for tables in (run.derived, run.element_series):
+            if planet in tables:
+                tables[planet] = tables[planet].time_slice(first, np.inf)
+    run.events = [event for event in run.events
+                  if event.get('jd', event.get('stop_jd')) > run.append_from.get(event['body'], -np.inf)]
+
+    if not any(len(data.get('vectors', ())) for data in run.orbits.values()):
+        print(f"No new vectors since the archive of {run.archive_base}; nothing to append")
+        return False
+
+    manifest = {'version': 1, 'segments': []}
+    if os.path.exists(segments_file(run.archive_base)):
+        with open(segments_file(run.archive_base)) as fh:
+            manifest = json.load(fh)
+    run.orbits_file = f"{run.archive_base}-{len(manifest['segments']) + 1:03d}"
+    manifest['segments'].append({'name': os.path.basename(run.orbits_file), 'after_jd': run.append_from})
+    run.segments = manifest
+    print_debug("Writing the new rows to the segment %s", run.orbits_file)
+    return True
+
+def record_append_segment(run):
+    # Lists the segment just written in <orbits_file>_segments.json, once its outputs exist
+    try:
+        with open(segments_file(run.archive_base), 'w') as fh:
+            json.dump(run.segments, fh, indent=2)
+        return True
+    except IOError as e:
+        print_error(f"Can't write {segments_file(run.archive_base)}: {e}")
+    return False
+
+@profiled('write npy', outputs=lambda run: list(archive_files(run.archive_base)))
+def append_orbit_data_npy(run):
+    # Writes the rows that are new since load_archive_for_append at the end of the archive as extra segments
+    archive_file, index_file = archive_files(run.archive_base)
+    try:
+        with open(index_file, 'r') as fh:
+            index = json.load(fh)
+        stored = {(entry['body'], entry['table']) for entry in index['entries']}
+
+        with open(archive_file, 'r+b') as fh:
+            fh.seek(0, os.SEEK_END)
+            for planet, data in run.orbits.items():
+                for table_name, dtype in (('elements', ELEMENTS_NPY_DTYPE), ('vectors', VECTORS_DTYPE)):
+                    if table_name not in data:
+                        continue
+                    table = data[table_name]
+                    if (planet, table_name) in stored:
+                        if table_name == 'elements' or planet not in run.append_from:
+                            continue  # elements are for the start epoch, which doesn't move
+                        table = table.time_slice(np.nextafter(run.append_from[planet], np.inf), np.inf)
+                    if len(table) == 0:
+                        continue
+                    fh.write(b"\0" * (-fh.tell() % ARCHIVE_ALIGNMENT))
+                    index['entries'].append({'body': planet, 'table': table_name, 'dtype': dtype.descr,
+                                             'offset': fh.tell(), 'rows': len(table)})
+                    for start in range(0, len(table), ARCHIVE_WRITE_ROWS):
+                        fh.write(table.row_slice(start, start + ARCHIVE_WRITE_ROWS).to_array(dtype).tobytes())
+                    print_debug("%s %s rows for %s appended to %s", len(table), table_name, planet, archive_file)
+
+        with open(index_file, 'w') as fh:
+            json.dump(index, fh, indent=2)
+        return True
+    except (IOError, ValueError, KeyError) as e:
+        print_error(f"Failed to append to {archive_file}: {e}")
+    return False
+
+# Adaptive decimation: drop vector samples that a cubic Hermite curve through the kept neighbours (using their
+# positions and velocities) reproduces within a tolerance. Coast arcs thin out a lot; burns and periapsis
+# passes, where the curve bends fastest, keep their dense sampling.
+
+SECONDS_PER_DAY = 86400.0
+decimation_tolerance_km = None  # decimation is off unless a tolerance is given
+
+def hermite_interpolate(t0, p0, v0, t1, p1, v1, t):
+    # Cubic Hermite between (t0, p0, v0) and (t1, p1, v1); times in days, positions in km, velocities in km/s.
+    # Endpoints are (..., 3) arrays broadcast against the query times t; returns positions and velocities.
+    h = (t1 - t0) * SECONDS_PER_DAY
+    s = ((t - t0) / (t1 - t0))[..., np.newaxis]
+    h = np.asarray(h)[..., np.newaxis]
+    s2 = s * s
+    s3 = s2 * s
+
+    position = ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * h * v0
+                + (3 * s2 - 2 * s3) * p1 + (s3 - s2) * h * v1)
+    velocity = ((6 * s2 - 6 * s) / h * p0 + (3 * s2 - 4 * s + 1) * v0
+                + (6 * s - 6 * s2) / h * p1 + (3 * s2 - 2 * s) * v1)
+    return position, velocity
+
+def decimate_vectors(table, tolerance_km):
+    # Returns the indices of the samples to keep and the largest position error of the dropped ones
+    jdct = table['jdct']
+    position, velocity = table.state_arrays()
+    n = len(jdct)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    max_error = 0.0
+
+    # Split every span whose interior is not reproduced within tolerance at its worst sample
+    spans = [(0, n - 1)]
+    while spans:
+        i, j = spans.pop()
+        if j - i < 2:
+            continue
+        fitted, _ = hermite_interpolate(jdct[i], position[i], velocity[i], jdct[j], position[j], velocity[j],
+                                        jdct[i + 1:j])
+        error = np.linalg.norm(fitted - position[i + 1:j], axis=1)
+        worst = int(np.argmax(error))
+        if error[worst] > tolerance_km:
+            k = i + 1 + worst
+            keep[k] = True
+            spans.extend([(i, k), (k, j)])
+        else:
+            max_error = max(max_error, float(error[worst]))
+
+    return np.flatnonzero(keep), max_error
+
+@profiled('decimate')
+def decimate_orbits(run, tolerance_km):
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data or len(data['vectors']) < 3:
+            continue
+        vectors = data['vectors']
+        kept, max_error = decimate_vectors(vectors, tolerance_km)
+        print(f"Decimated {planet} vectors: {len(vectors)} -> {len(kept)} points "
+              f"({len(vectors) / len(kept):.1f}x), max error {max_error:.3f} km")
+        data['vectors'] = OrbitTable({name: column[kept] for name, column in vectors.columns.items()})
+
+# Ephemeris queries: states at arbitrary epochs, Hermite-interpolated between the bracketing samples. Evenly
+# spaced tables locate the bracketing samples arithmetically in O(1) per epoch, others by binary search.
+
+densify_step_minutes = None
+
+def interpolate_vectors(table, jd_array):
+    jdct = table['jdct']
+    t = np.asarray(jd_array, dtype=np.float64)
+    if len(jdct) < 2:
+        raise ValueError("At least two vector samples are needed to interpolate")
+    if t.size and (t.min() < jdct[0] or t.max() > jdct[-1]):
+        raise ValueError(f"Epochs outside the table span {jdct[0]:.6f} .. {jdct[-1]:.6f}")
+
+    step = table.uniform_step()
+    if step is not None:
+        i = np.clip(np.floor((t - jdct[0]) / step).astype(np.int64), 0, len(jdct) - 2)
+        i += (jdct[i + 1] <= t) & (i < len(jdct) - 2)  # the grid can be a row off the rounded epochs
+        i -= (jdct[i] > t)
+    else:
+        i = np.searchsorted(jdct, t, side='right') - 1
+    i = np.clip(i, 0, len(jdct) - 2)
+
+    position, velocity = table.state_arrays()
+    return hermite_interpolate(jdct[i], position[i], velocity[i], jdct[i + 1], position[i + 1], velocity[i + 1], t)
+
+def state_at(run, planet, jd_array):
+    # Positions (km) and velocities (km/s) of a parsed body at the given epochs, as two (n, 3) arrays
+    return interpolate_vectors(run.orbits[planet]['vectors'], jd_array)
+
+def resample_vectors(table, step_days):
+    jdct = table['jdct']
+    count = int(np.floor((jdct[-1] - jdct[0]) / step_days + 1e-9)) + 1
+    t = jdct[0] + np.arange(count) * step_days
+    position, velocity = interpolate_vectors(table, t)
+    return OrbitTable.from_states(t, position, velocity)
+
+@profiled('densify')
+def densify_orbits(run, step_minutes):
+    for planet, data in run.orbits.items():
+        if 'vectors' in data and len(data['vectors']) >= 2:
+            before = len(data['vectors'])
+            data['vectors'] = resample_vectors(data['vectors'], step_minutes / 1440.0)
+            print_debug("Resampled %s vectors at %s min: %s -> %s points", planet, step_minutes, before, len(data['vectors']))
+
+# Chebyshev compression in the spirit of SPK type 2 segments: each body's span is cut into equal intervals and
+# x, y, z on every interval are a Chebyshev series in normalized time; velocities are its time derivative.
+# All intervals are fitted at once from Hermite-interpolated samples at their Chebyshev nodes.
+
+chebyshev_interval_days = None  # Chebyshev export is off unless an interval is given
+chebyshev_degree = 12
+
+def fit_chebyshev_segments(table, interval_days, degree):
+    jdct = table['jdct']
+    span = jdct[-1] - jdct[0]
+    count = max(1, int(np.ceil(span / interval_days - 1e-9)))
+    interval_days = span / count  # equal intervals that end exactly on the last sample
+
+    nodes = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    midpoints = jdct[0] + (np.arange(count) + 0.5) * interval_days
+    epochs = midpoints[:, np.newaxis] + 0.5 * interval_days * nodes
+    position, _ = interpolate_vectors(table, np.clip(epochs.ravel(), jdct[0], jdct[-1]))
+    position = position.reshape(count, degree + 1, 3)
+
+    # Discrete orthogonality of T_j over the nodes turns the fit into one matrix product for all intervals
+    vander = np.polynomial.chebyshev.chebvander(nodes, degree)
+    coefficients = np.einsum('kj,skc->scj', vander, position) * (2.0 / (degree + 1))
+    coefficients[..., 0] /= 2
+    return {'init_jd': float(jdct[0]), 'interval_days': float(interval_days), 'position': coefficients}
+
+def clenshaw(coefficients, x):
+    # Sum of c_j T_j(x) over the last axis of coefficients; x broadcasts against the other axes
+    b1 = np.zeros(coefficients.shape[:-1])
+    b2 = np.zeros_like(b1)
+    for j in range(coefficients.shape[-1] - 1, 0, -1):
+        b1, b2 = 2 * x * b1 - b2 + coefficients[..., j], b1
+    return x * b1 - b2 + coefficients[..., 0]
+
+def chebyshev_state_at(segments, jd_array):
+    # Positions (km) and velocities (km/s) from fitted segments; constant time per epoch
+    t = np.asarray(jd_array, dtype=np.float64)
+    interval_days = segments['interval_days']
+    coefficients = segments['position']
+    index = np.clip(np.floor((t - segments['init_jd']) / interval_days).astype(np.int64), 0, len(coefficients) - 1)
+    radius = 0.5 * interval_days
+    x = ((t - segments['init_jd'] - index * interval_days) / radius - 1.0)[:, np.newaxis]
+
+    selected = coefficients[index]
+    position = clenshaw(selected, x)
+    derivative = np.polynomial.chebyshev.chebder(selected, axis=-1)
+    velocity = clenshaw(derivative, x) / (radius * SECONDS_PER_DAY)
+    return position, velocity
+
+@profiled('write chebyshev', outputs=lambda run: [f"{run.orbits_file}_chebyshev.npz"])
+def save_orbit_data_chebyshev(run):
+    print_debug("Entering save_orbit_data_chebyshev")
+
+    arrays = {}
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data or len(data['vectors']) < 2:
+            continue
+        vectors = data['vectors']
+        segments = fit_chebyshev_segments(vectors, chebyshev_interval_days, chebyshev_degree)
+        arrays[f"{planet}.position"] = segments['position']
+        arrays[f"{planet}.domain"] = np.array([segments['init_jd'], segments['interval_days']])
+
+        position, _ = chebyshev_state_at(segments, vectors['jdct'])
+        error = np.linalg.norm(position - vectors.state_arrays()[0], axis=1).max()
+        raw_bytes = len(vectors) * VECTORS_DTYPE.itemsize
+        print(f"Chebyshev fit of {planet}: {len(segments['position'])} segments of degree {chebyshev_degree}, "
+              f"{segments['position'].nbytes} bytes vs {raw_bytes} ({raw_bytes / segments['position'].nbytes:.1f}x), "
+              f"max error {error:.3f} km")
+
+    chebyshev_file = f"{run.orbits_file}_chebyshev.npz"
+    try:
+        os.makedirs(os.path.dirname(chebyshev_file), exist_ok=True)
+        np.savez(chebyshev_file, **arrays)
+        print_debug("Chebyshev segments written to %s", chebyshev_file)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing to {chebyshev_file}: {e}")
+    return False
+
+def load_chebyshev_segments(chebyshev_file):
+    # Returns {planet: segments} for use with chebyshev_state_at
+    segments = {}
+    with np.load(chebyshev_file) as archive:
+        for key in archive.files:
+            planet, _, name = key.rpartition('.')
+            if name == 'domain':
+                init_jd, interval_days = archive[key]
+                segments[planet] = {'init_jd': float(init_jd), 'interval_days': float(interval_days),
+                                    'position': archive[f"{planet}.position"]}
+    return segments
+
+# Time-tiled output: the vectors of every body are cut into tiles of tile_days, aligned to 0h UTC, with a
+# manifest the viewer reads first to find the tiles around the current animation time. Each tile also holds
+# the first sample of the next one, so a tile can be interpolated up to its end without loading a neighbour.
+
+tile_days = 1.0
+
+@profiled('write tiles', outputs=lambda run: [f"{run.orbits_file}-tiles"])
+def save_orbit_data_tiles(run):
+    print_debug("Entering save_orbit_data_tiles")
+
+    tiles_dir = f"{run.orbits_file}-tiles"
+    manifest = {'tile_days': tile_days, 'bodies': {}}
+    try:
+        os.makedirs(tiles_dir, exist_ok=True)
+        for planet, data in run.orbits.items():
+            body = manifest['bodies'][planet] = {'tiles': []}
+            if 'elements' in data:
+                body['elements'] = {f"{rec['jdct']:.9f}": rec for rec in data['elements'].records()}
+            if 'vectors' not in data or len(data['vectors']) == 0:
+                continue
+
+            vectors = data['vectors']
+            jdct = vectors['jdct']
+            origin = np.floor(jdct[0] - 0.5) + 0.5  # 0h UTC on the day of the first sample
+            tile_index = np.floor((jdct - origin) / tile_days + 1e-9).astype(np.int64)  # 1e-9 d guards rounding at 0h
+            indices, starts = np.unique(tile_index, return_index=True)
+            stops = np.append(starts[1:] + 1, len(jdct))  # inclusive of the next tile's first sample
+
+            fn = filename_for_planet(planet)
+            for index, start, stop in zip(indices.tolist(), starts.tolist(), stops.tolist()):
+                tile_file = f"{fn}-{index:04d}.json"
+                with open(os.path.join(tiles_dir, tile_file), 'w') as fh:
+                    rows = vectors.row_slice(start, stop)
+                    fh.write("[" + ",\n".join(json.dumps(rec) for rec in rows.records()) + "]\n")
+                body['tiles'].append({
+                    'file': tile_file,
+                    'start_jd': origin + index * tile_days,
+                    'stop_jd': origin + (index + 1) * tile_days,
+                    'first_jd': float(jdct[start]),
+                    'last_jd': float(jdct[stop - 1]),
+                    'rows': stop - start,
+                })
+
+        with open(os.path.join(tiles_dir, "manifest.json"), 'w') as fh:
+            json.dump(manifest, fh, indent=2)
+        print_debug("Tiles written to %s", tiles_dir)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing tiles to {tiles_dir}: {e}")
+    return False
+
+# Binary orbit file: an 8-byte magic, a little-endian uint32 format version and uint32 header length, a JSON
+# header, then the data section starting at the next 8-byte boundary. The header lists every body's tables
+# with their row counts and, per column, its dtype and byte offset into the data section. Every column is one
+# little-endian block aligned to 8 bytes, so a reader can wrap it in a typed array view without copying.
+
+BINARY_MAGIC = b"CY3ORBIT"
+BINARY_VERSION = 1
+BINARY_ALIGNMENT = 8
+binary_precision = 32  # bits per vector component in the binary file; jdct and elements are always 64 bit
+
+def binary_column_dtype(table_name, column_name):
+    if table_name == 'vectors' and column_name != 'jdct' and binary_precision == 32:
+        return np.dtype('<f4')
+    return np.dtype('<f8')
+
+def binary_data_start(header_length):
+    start = len(BINARY_MAGIC) + 8 + header_length
+    return start + (-start % BINARY_ALIGNMENT)
+
+@profiled('write binary', outputs=lambda run: [f"{run.orbits_file}.bin"])
+def save_orbit_data_binary(run):
+    print_debug("Entering save_orbit_data_binary")
+
+    header = {'bodies': {}}
+    blocks = []
+    offset = 0
+    for planet, data in run.orbits.items():
+        body = header['bodies'][planet] = {}
+        for table_name in ('elements', 'vectors'):
+            if table_name not in data:
+                continue
+            table = data[table_name]
+            columns = {}
+            for column_name in table.fields:
+                if table_name == 'elements' and column_name == 'date':
+                    continue  # derivable from jdct
+                dtype = binary_column_dtype(table_name, column_name)
+                offset += -offset % BINARY_ALIGNMENT
+                columns[column_name] = {'dtype': dtype.str, 'offset': offset}
+                blocks.append((offset, np.ascontiguousarray(table[column_name], dtype=dtype)))
+                offset += len(table) * dtype.itemsize
+            body[table_name] = {'rows': len(table), 'columns': columns}
+    data_size = offset
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = binary_data_start(len(header_bytes))
+
+    binary_file = f"{run.orbits_file}.bin"
+    try:
+        os.makedirs(os.path.dirname(binary_file), exist_ok=True)
+        with open(binary_file, 'wb') as fh:
+            fh.write(BINARY_MAGIC)
+            fh.write(np.array([BINARY_VERSION, len(header_bytes)], dtype='<u4').tobytes())
+            fh.write(header_bytes)
+            for offset, column in blocks:
+                fh.seek(data_start + offset)
+                fh.write(column.tobytes())
+            fh.truncate(data_start + data_size)
+        print_debug("Binary data written to %s", binary_file)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing to {binary_file}: {e}")
+    return False
+
+def load_orbit_data_binary(binary_file):
+    # Returns {planet: {table: {column: array}}}; the arrays are read-only views of one buffer
+    with open(binary_file, 'rb') as fh:
+        buffer = fh.read()
+
+    if buffer[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError(f"{binary_file} is not an orbit binary file")
+    version, header_length = np.frombuffer(buffer, dtype='<u4', count=2, offset=len(BINARY_MAGIC))
+    if version != BINARY_VERSION:
+        raise ValueError(f"{binary_file} has unsupported format version {version}")
+    header_start = len(BINARY_MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_length])
+    data_start = binary_data_start(int(header_length))
+
+    result = {}
+    for planet, body in header['bodies'].items():
+        result[planet] = {}
+        for table_name, table in body.items():
+            result[planet][table_name] = {
+                column_name: np.frombuffer(buffer, dtype=column['dtype'], count=table['rows'],
+                                           offset=data_start + column['offset'])
+                for column_name, column in table['columns'].items()
+            }
+    return result
+
+# Derived quantities: per-sample distance, altitude, speed and, around the Moon, the selenographic ground track,
+# plus a table of events -- apsis passages, burns and the closest approach of each pair of craft. These are
+# computed once for the whole run with array operations, so the viewer need not derive them every frame.
+
+# Mean radius (km) and GM (km^3/s^2) of the bodies that can be the center of a run
+CENTER_BODIES = {
+    JPL_EARTH_CENTER: {'name': 'EARTH', 'radius_km': 6371.0, 'gm': 398600.435436},
+    JPL_MOON_CENTER:  {'name': 'MOON',  'radius_km': 1737.4, 'gm': 4902.800066},
+}
+
+J2000_JD = 2451545.0
+J2000_OBLIQUITY_DEG = 84381.448 / 3600.0  # Horizons vectors are referred to the J2000 ecliptic
+
+# A burn is a stretch of samples over which the orbital energy changes faster than gravity perturbations do:
+# the tangential acceleration implied by the change (dE/dt divided by the speed) exceeds this, in km/s^2.
+# The CY3 propulsion module's 440 N engine gives about 1e-4 km/s^2.
+burn_acceleration_threshold = 3e-5
+
+def ecliptic_to_equatorial(position):
+    eps = np.radians(J2000_OBLIQUITY_DEG)
+    x, y, z = position[:, 0], position[:, 1], position[:, 2]
+    return np.column_stack((x, y * np.cos(eps) - z * np.sin(eps), y * np.sin(eps) + z * np.cos(eps)))
+
+def moon_orientation(jdct):
+    # Right ascension and declination of the Moon's north pole and its prime meridian angle W, in degrees,
+    # from the IAU WGCCRE rotation model of the Moon (Archinal et al. 2011)
+    d = jdct - J2000_JD
+    T = d / 36525.0
+    E = np.radians(np.array([
+        125.045 - 0.0529921 * d, 250.089 - 0.1059842 * d, 260.008 + 13.0120009 * d,
+        176.625 + 13.3407154 * d, 357.529 + 0.9856003 * d, 311.589 + 26.4057084 * d,
+        134.963 + 13.0649930 * d, 276.617 + 0.3287146 * d, 34.226 + 1.7484877 * d,
+        15.134 - 0.1589763 * d, 119.743 + 0.0036096 * d, 239.961 + 0.1643573 * d,
+        25.053 + 12.9590088 * d,
+    ]))
+    sin_E, cos_E = np.sin(E), np.cos(E)
+    alpha = (269.9949 + 0.0031 * T - 3.8787 * sin_E[0] - 0.1204 * sin_E[1] + 0.0700 * sin_E[2]
+             - 0.0172 * sin_E[3] + 0.0072 * sin_E[5] - 0.0052 * sin_E[9] + 0.0043 * sin_E[12])
+    delta = (66.5392 + 0.0130 * T + 1.5419 * cos_E[0] + 0.0239 * cos_E[1] - 0.0278 * cos_E[2]
+             + 0.0068 * cos_E[3] - 0.0029 * cos_E[5] + 0.0009 * cos_E[6] + 0.0008 * cos_E[9] - 0.0009 * cos_E[12])
+    W = (38.3213 + 13.17635815 * d - 1.4e-12 * d * d + 3.5610 * sin_E[0] + 0.1208 * sin_E[1]
+         - 0.0642 * sin_E[2] + 0.0158 * sin_E[3] + 0.0252 * sin_E[4] - 0.0066 * sin_E[5] - 0.0047 * sin_E[6]
+         - 0.0046 * sin_E[7] + 0.0028 * sin_E[8] + 0.0052 * sin_E[9] + 0.0040 * sin_E[10] + 0.0019 * sin_E[11]
+         - 0.0044 * sin_E[12])
+    return alpha, delta, W
+
+def ecliptic_to_moon_fixed(jdct, vectors):
+    # Selenocentric ecliptic J2000 vectors, (n, 3), in the Moon's body-fixed axes at the epochs jdct
+    alpha, delta, W = (np.radians(angle) for angle in moon_orientation(jdct))
+    p = ecliptic_to_equatorial(vectors)
+
+    # Rz(W) Rx(90 - delta) Rz(90 + alpha) takes equatorial J2000 to body-fixed axes
+    ca, sa = np.cos(alpha), np.sin(alpha)
+    x1 = -sa * p[:, 0] + ca * p[:, 1]
+    y1 = -ca * p[:, 0] - sa * p[:, 1]
+    sd, cd = np.sin(delta), np.cos(delta)
+    y2 = sd * y1 + cd * p[:, 2]
+    z2 = -cd * y1 + sd * p[:, 2]
+    cw, sw = np.cos(W), np.sin(W)
+    x3 = cw * x1 + sw * y2
+    y3 = -sw * x1 + cw * y2
+    return np.column_stack((x3, y3, z2))
+
+def selenographic_coordinates(jdct, position):
+    # Latitude and east longitude (degrees) under selenocentric ecliptic positions
+    fixed = ecliptic_to_moon_fixed(jdct, position)
+    lat = np.degrees(np.arctan2(fixed[:, 2], np.hypot(fixed[:, 0], fixed[:, 1])))
+    lon = np.degrees(np.arctan2(fixed[:, 1], fixed[:, 0]))
+    return lat, lon
+
+def derived_columns(table, center_body, ground_track):
+    jdct = table['jdct']
+    position, velocity = table.state_arrays()
+    r = np.linalg.norm(position, axis=1)
+    columns = {
+        'jdct': jdct,
+        'r': r,
+        'altitude': r - center_body['radius_km'],
+        'speed': np.linalg.norm(velocity, axis=1),
+    }
+    if ground_track:
+        columns['lat'], columns['lon'] = selenographic_coordinates(jdct, position)
+    return columns
+
+def find_apsides(table, planet, center_body):
+    # Periapsis and apoapsis passages are the sign changes of the radial velocity r.v; the epoch is found
+    # by linear interpolation of r.v between the bracketing samples and the distance there by Hermite
+    jdct = table['jdct']
+    position, velocity = table.state_arrays()
+    radial = np.einsum('ij,ij->i', position, velocity)
+    i = np.flatnonzero((radial[:-1] < 0) != (radial[1:] < 0))
+    if len(i) == 0:
+        return []
+    t = jdct[i] - radial[i] * (jdct[i + 1] - jdct[i]) / (radial[i + 1] - radial[i])
+    r = np.linalg.norm(interpolate_vectors(table, t)[0], axis=1)
+
+    return [{
+        'type': 'periapsis' if radial[k] < 0 else 'apoapsis',
+        'body': planet,
+        'jd': float(jd),
+        'r': float(distance),
+        'altitude': float(distance - center_body['radius_km']),
+    } for k, jd, distance in zip(i.tolist(), t, r)]
+
+# Two-body energy about the run's center is only conserved where the center's gravity dominates: seen from the
+# Earth a craft in lunar orbit, or seen from the Moon one in Earth orbit, changes energy every revolution. So
+# every sample is referred to the dominant body, the Moon inside its sphere of influence and the Earth outside,
+# using the vectors of the other one where the run has them. Steps whose dominant body changes or isn't known
+# are not tested for burns.
+LUNAR_SOI_KM = 66100.0
+MOON_PERIGEE_KM = 356400.0  # closest the Moon comes to the Earth
+
+def dominant_body_states(table, center_body, primary_table):
+    # Position, velocity and GM of every sample about its dominant body, plus a mask of the samples where that
+    # body is known and its vectors available. primary_table holds the vectors of the other primary -- the Moon
+    # in an Earth-centred run, the Earth in a Moon-centred one -- relative to the center, or is None.
+    jdct = table['jdct']
+    position, velocity = (a.copy() for a in table.state_arrays())  # the table's cached arrays stay untouched
+    gm = np.full(len(jdct), center_body['gm'])
+    known = np.ones(len(jdct), dtype=bool)
+
+    primary_position = np.full(position.shape, np.nan)
+    primary_velocity = np.full(velocity.shape, np.nan)
+    if primary_table is not None and len(primary_table) >= 2:
+        primary_jdct = primary_table['jdct']
+        inside = (jdct >= primary_jdct[0]) & (jdct <= primary_jdct[-1])
+        primary_position[inside], primary_velocity[inside] = interpolate_vectors(primary_table, jdct[inside])
+    have_primary = ~np.isnan(primary_position[:, 0])
+
+    if center_body['name'] == 'MOON':
+        elsewhere = np.linalg.norm(position, axis=1) > LUNAR_SOI_KM
+        other = CENTER_BODIES[JPL_EARTH_CENTER]
+        known[elsewhere & ~have_primary] = False
+    else:
+        moon_distance = np.linalg.norm(position - primary_position, axis=1)
+        elsewhere = have_primary & (moon_distance < LUNAR_SOI_KM)
+        other = CENTER_BODIES[JPL_MOON_CENTER]
+        # Without the Moon's vectors only samples too far inside its orbit to be near it can be placed
+        known[~have_primary] = np.linalg.norm(position[~have_primary], axis=1) < MOON_PERIGEE_KM - LUNAR_SOI_KM
+
+    moved = elsewhere & have_primary
+    position[moved] -= primary_position[moved]
+    velocity[moved] -= primary_velocity[moved]
+    gm[moved] = other['gm']
+    return position, velocity, gm, known, elsewhere
+
+def find_burns(table, planet, center_body, primary_table=None):
+    # Samples between which the specific orbital energy about the dominant body changes faster than
+    # burn_acceleration_threshold allows, merged into burns when at most one quiet step apart. The semi-major
+    # axis about that body is reported on either side, and the delta-v as the accumulated tangential speed
+    # change |dE| / v.
+    jdct = table['jdct']
+    if len(jdct) < 3:
+        return []
+    position, velocity, gm, known, elsewhere = dominant_body_states(table, center_body, primary_table)
+    speed = np.linalg.norm(velocity, axis=1)
+    energy = 0.5 * speed * speed - gm / np.linalg.norm(position, axis=1)
+
+    tested = known[:-1] & known[1:] & (elsewhere[:-1] == elsewhere[1:])
+    dE = np.where(tested, np.diff(energy), 0.0)
+    dt = np.diff(jdct) * SECONDS_PER_DAY
+    mean_speed = 0.5 * (speed[:-1] + speed[1:])
+    flagged = np.abs(dE) / (mean_speed * dt) > burn_acceleration_threshold
+    steps = np.flatnonzero(flagged)
+    if len(steps) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(steps) > 2)
+    first_steps = steps[np.r_[0, breaks + 1]]
+    last_steps = steps[np.r_[breaks, len(steps) - 1]]
+    dv = np.cumsum(np.r_[0.0, np.abs(dE) / mean_speed])
+
+    def semi_major_axis(k):
+        return float(-gm[k] / (2 * energy[k])) if energy[k] < 0 else None  # None once unbound
+
+    return [{
+        'type': 'burn',
+        'body': planet,
+        'start_jd': float(jdct[first]),
+        'stop_jd': float(jdct[last + 1]),
+        'a_before': semi_major_axis(first),
+        'a_after': semi_major_axis(last + 1),
+        'delta_v': float(dv[last + 1] - dv[first]),
+    } for first, last in zip(first_steps.tolist(), last_steps.tolist())]
+
+def find_closest_approach(table, other_table, planet, other):
+    # The minimum distance between two bodies over their common span, sampled at the first body's epochs
+    # and refined to the zero of d|dp|^2/dt = 2 dp.dv by Hermite interpolation of both
+    jdct = table['jdct']
+    other_jdct = other_table['jdct']
+    inside = (jdct >= other_jdct[0]) & (jdct <= other_jdct[-1])
+    if np.count_nonzero(inside) < 2:
+        return None
+    t = jdct[inside]
+    position, velocity = (a[inside] for a in table.state_arrays())
+    other_position, other_velocity = interpolate_vectors(other_table, t)
+    dp, dv = position - other_position, velocity - other_velocity
+    k = int(np.argmin(np.einsum('ij,ij->i', dp, dp)))
+
+    jd = t[k]
+    closing = np.einsum('ij,ij->i', dp, dv)
+    for a, b in ((k - 1, k), (k, k + 1)):
+        if 0 <= a and b < len(t) and closing[a] < 0 <= closing[b]:
+            jd = t[a] - closing[a] * (t[b] - t[a]) / (closing[b] - closing[a])
+    distance = np.linalg.norm(interpolate_vectors(table, [jd])[0] - interpolate_vectors(other_table, [jd])[0])
+
+    return {'type': 'closest_approach', 'body': planet, 'other': other, 'jd': float(jd), 'distance': float(distance)}
+
+@profiled('derive')
+def compute_derived_quantities(run):
+    center_body = CENTER_BODIES.get(run.center)
+    if center_body is None:
+        print_error(f"No radius and GM known for center {run.center}; skipping derived quantities")
+        return False
+
+    run.derived = {}
+    run.events = []
+    crafts = []
+    primary = 'EARTH' if center_body['name'] == 'MOON' else 'MOON'
+    primary_table = run.orbits.get(primary, {}).get('vectors')
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data or len(data['vectors']) < 2:
+            continue
+        table = data['vectors']
+        ground_track = center_body['name'] == 'MOON' and planet != 'MOON'
+        run.derived[planet] = OrbitTable(derived_columns(table, center_body, ground_track))
+        run.events.extend(find_apsides(table, planet, center_body))
+
+        code = planet_codes[planet]
+        if isinstance(code, int) and code < 0:
+            crafts.append(planet)
+            run.events.extend(find_burns(table, planet, center_body, primary_table))
+
+    for i, planet in enumerate(crafts):
+        for other in crafts[i + 1:]:
+            event = find_closest_approach(run.orbits[planet]['vectors'], run.orbits[other]['vectors'], planet, other)
+            if event is not None:
+                run.events.append(event)
+
+    run.events.sort(key=lambda event: event.get('jd', event.get('start_jd')))
+    print_debug("Derived quantities for %s: %s events", ', '.join(run.derived), len(run.events))
+    return True
+
+# Rounding of the derived columns in the JSON: whole metres, mm/s and about a metre on the lunar surface
+DERIVED_DECIMALS = {'r': 3, 'altitude': 3, 'speed': 6, 'lat': 5, 'lon': 5}
+
+@profiled('write derived', outputs=lambda run: [f"{run.orbits_file}_derived.json"])
+def save_orbit_data_derived(run):
+    print_debug("Entering save_orbit_data_derived")
+
+    derived_file = f"{run.orbits_file}_derived.json"
+    output = {'version': 1, 'center': CENTER_BODIES[run.center]['name'], 'bodies': {}, 'events': run.events}
+    for planet, table in run.derived.items():
+        output['bodies'][planet] = {name: (np.round(table[name], DERIVED_DECIMALS[name]) if name in DERIVED_DECIMALS
+                                           else table[name]).tolist() for name in table.fields}
+    try:
+        os.makedirs(os.path.dirname(derived_file), exist_ok=True)
+        with open(derived_file, 'w') as fh:
+            json.dump(output, fh)
+        print_debug("Derived quantities written to %s", derived_file)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing to {derived_file}: {e}")
+    return False
+
+# Selenocentric states from geocentric fetches: with --selenocentric-from-geo a Moon-centred phase fetches
+# its bodies and the Moon relative to the Earth, the same queries as the geo phase, and subtracts the Moon's
+# state, Hermite-interpolated at each body's epochs. The Earth's state is minus the Moon's. Elements are still
+# fetched relative to the Moon. --selenocentric-check also fetches the vectors directly and compares.
+
+selenocentric_from_geo = False
+selenocentric_check = False
+selenocentric_tolerance_km = 1e-3
+selenocentric_frame = 'ecliptic'  # or 'moon-fixed': the Moon's body-fixed axes of the IAU rotation model
+MOON_ROTATION_RATE = np.radians(13.17635815) / 86400  # rad/s, the secular rate of the prime meridian W
+
+def derives_selenocentric(run):
+    return selenocentric_from_geo and run.center == JPL_MOON_CENTER
+
+def is_geocenter(planet):
+    return planet_codes[planet] == JPL_EARTH
+
+def selenocentric_fetch_jobs(run, vectors_options):
+    # Replaces the Moon-centred vectors jobs of a run; vectors_options maps planet to its vectors job options
+    jobs = []
+    for planet, options in vectors_options.items():
+        if not is_geocenter(planet):
+            jobs.append((planet, dict(options, center=JPL_EARTH_CENTER)))
+        if selenocentric_check:
+            jobs.append((planet, dict(options, chunks_key='direct_vectors_chunks')))
+
+    # The Moon over the union of the bodies' windows, on the grid of the earliest one
+    starts = [options['start_time'] for options in vectors_options.values()]
+    stops = [options['stop_time'] for options in vectors_options.values()]
+    moon = dict(next(iter(vectors_options.values())), center=JPL_EARTH_CENTER,
+                start_time=min(starts, key=parse_horizons_time), stop_time=max(stops, key=parse_horizons_time))
+    jobs.append(('MOON', moon))
+    return jobs
+
+@profiled('selenocentric')
+def derive_selenocentric_vectors(run):
+    moon = OrbitTable.from_array(parse_horizons_stream(horizons_lines(run, 'MOON', 'vectors'), 'vectors'))
+    moon_position, moon_velocity = moon.state_arrays()
+
+    for planet in run.planets:
+        if is_geocenter(planet):
+            jdct, position, velocity = moon['jdct'], -moon_position, -moon_velocity
+        else:
+            table = run.orbits[planet]['vectors']
+            jdct = table['jdct']
+            try:
+                moon_at, moon_velocity_at = interpolate_vectors(moon, jdct)
+            except ValueError as e:
+                print_error(f"Can't place the Moon at the epochs of {planet}: {e}")
+                return False
+            position, velocity = table.state_arrays()
+            position, velocity = position - moon_at, velocity - moon_velocity_at
+        vectors = OrbitTable.from_states(jdct, position, velocity)
+        run.orbits.setdefault(planet, {})['vectors'] = vectors
+
+        if selenocentric_check:
+            direct = OrbitTable.from_array(parse_horizons_stream(horizons_lines(run, planet, 'direct_vectors'), 'vectors'))
+            _, i, j = np.intersect1d(jdct, direct['jdct'], assume_unique=True, return_indices=True)
+            if len(i) == 0:
+                print_error(f"Derived and fetched vectors of {planet} have no epochs in common")
+                return False
+            derived_position, derived_velocity = vectors.state_arrays()
+            direct_position, direct_velocity = direct.state_arrays()
+            error = np.max(np.linalg.norm(derived_position[i] - direct_position[j], axis=1))
+            velocity_error = np.max(np.linalg.norm(derived_velocity[i] - direct_velocity[j], axis=1))
+            print_debug("Selenocentric %s from geocentric vectors: max error %.6f km, %.3e km/s over %s epochs", planet, error, velocity_error, len(i))
+            if error > selenocentric_tolerance_km:
+                print_error(f"Selenocentric {planet} derived from geocentric vectors is off by {error:.6f} km "
+                            f"(tolerance {selenocentric_tolerance_km} km)")
+                return False
+
+    run.orbits = {planet: run.orbits[planet] for planet in run.planets if planet in run.orbits}
+    return True
+
+def rotate_selenocentric_frame(run):
+    # Turns the Moon-centred ecliptic vectors of the run into selenocentric_frame. Velocities in the body-fixed
+    # frame are relative to the rotating axes: v' = R v - w x r', with w along the Moon's pole.
+    if selenocentric_frame == 'ecliptic' or run.center != JPL_MOON_CENTER:
+        return
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data:
+            continue
+        jdct = data['vectors']['jdct']
+        position, velocity = data['vectors'].state_arrays()
+        position = ecliptic_to_moon_fixed(jdct, position)
+        velocity = ecliptic_to_moon_fixed(jdct, velocity)
+        velocity[:, 0] += MOON_ROTATION_RATE * position[:, 1]
+        velocity[:, 1] -= MOON_ROTATION_RATE * position[:, 0]
+        data['vectors'] = OrbitTable.from_states(jdct, position, velocity)
+    print_debug("Vectors of %s rotated into the %s frame", ', '.join(run.orbits), selenocentric_frame)
+
+# Kepler propagation: states from osculating elements (ec, qr, in, om, w, tp, n as Horizons gives them, with
+# angles in degrees, tp a JD and n in deg/s) for elliptic and hyperbolic orbits, Newton-solving Kepler's
+# equation for all epochs at once. Positions and velocities are in the frame of the elements, the ecliptic of
+# J2000 for Horizons. --kepler-report propagates every body's fetched elements over its fetched vectors and
+# reports how far the two-body coast drifts from them, up to the first burn and overall.
+
+kepler_reporting = False
+kepler_tolerance_km = 1.0  # drift up to which a propagated coast is counted as usable
+KEPLER_MAX_ITERATIONS = 50
+
+def solve_kepler(M, e):
+    # Eccentric anomaly E with E - e sin E = M, for M in [-pi, pi] and e < 1
+    E = np.where(e < 0.8, M, np.pi * np.sign(M))
+    for _ in range(KEPLER_MAX_ITERATIONS):
+        delta = (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+        E -= delta
+        if np.all(np.abs(delta) < 1e-12):
+            break
+    return E
+
+def solve_kepler_hyperbolic(M, e):
+    # Hyperbolic anomaly H with e sinh H - H = M, for e > 1
+    H = np.sign(M) * np.log(2 * np.abs(M) / e + 1.8)
+    for _ in range(KEPLER_MAX_ITERATIONS):
+        delta = (e * np.sinh(H) - H - M) / (e * np.cosh(H) - 1)
+        H -= delta
+        if np.all(np.abs(delta) < 1e-12 * np.maximum(1, np.abs(H))):
+            break
+    return H
+
+def kepler_propagate(elements, jd_array):
+    # Positions (km) and velocities (km/s), two (n, 3) arrays, at the epochs jd_array. elements maps ec, qr,
+    # in, om, w, tp and n to scalars or to arrays of one element set per epoch.
+    t = np.asarray(jd_array, dtype=np.float64)
+    e, q, tp = (np.broadcast_to(np.asarray(elements[name], dtype=np.float64), t.shape) for name in ('ec', 'qr', 'tp'))
+    n = np.broadcast_to(np.radians(np.asarray(elements['n'], dtype=np.float64)), t.shape)
+    if np.any(np.abs(e - 1) < 1e-9):
+        raise ValueError("Parabolic orbits are not supported")
+    M = n * (t - tp) * SECONDS_PER_DAY
+
+    x, y, vx, vy = (np.empty(t.shape) for _ in range(4))
+    elliptic = e < 1
+    if np.any(elliptic):
+        ee, nn = e[elliptic], n[elliptic]
+        a = q[elliptic] / (1 - ee)
+        b = a * np.sqrt(1 - ee * ee)
+        E = solve_kepler(np.remainder(M[elliptic] + np.pi, 2 * np.pi) - np.pi, ee)
+        rate = nn / (1 - ee * np.cos(E))  # dE/dt
+        x[elliptic], y[elliptic] = a * (np.cos(E) - ee), b * np.sin(E)
+        vx[elliptic], vy[elliptic] = -a * np.sin(E) * rate, b * np.cos(E) * rate
+    hyperbolic = ~elliptic
+    if np.any(hyperbolic):
+        ee, nn = e[hyperbolic], n[hyperbolic]
+        a = q[hyperbolic] / (ee - 1)
+        b = a * np.sqrt(ee * ee - 1)
+        H = solve_kepler_hyperbolic(M[hyperbolic], ee)
+        rate = nn / (ee * np.cosh(H) - 1)  # dH/dt
+        x[hyperbolic], y[hyperbolic] = a * (ee - np.cosh(H)), b * np.sinh(H)
+        vx[hyperbolic], vy[hyperbolic] = -a * np.sinh(H) * rate, b * np.cosh(H) * rate
+
+    # Perifocal to reference axes: the unit vectors P towards periapsis and Q 90 degrees ahead of it
+    i, om, w = (np.broadcast_to(np.radians(np.asarray(elements[name], dtype=np.float64)), t.shape) for name in ('in', 'om', 'w'))
+    cos_om, sin_om, cos_w, sin_w, cos_i, sin_i = np.cos(om), np.sin(om), np.cos(w), np.sin(w), np.cos(i), np.sin(i)
+    P = np.stack((cos_om * cos_w - sin_om * sin_w * cos_i, sin_om * cos_w + cos_om * sin_w * cos_i, sin_w * sin_i), axis=-1)
+    Q = np.stack((-cos_om * sin_w - sin_om * cos_w * cos_i, -sin_om * sin_w + cos_om * cos_w * cos_i, cos_w * sin_i), axis=-1)
+    position = x[..., np.newaxis] * P + y[..., np.newaxis] * Q
+    velocity = vx[..., np.newaxis] * P + vy[..., np.newaxis] * Q
+    return position, velocity
+
+def propagate_elements(elements_table, jd_array):
+    # Vectors at jd_array from the latest element set at or before each epoch (the first one before it), so
+    # element sets fetched at the start of every coast arc regenerate the vectors of all of them
+    jdct = elements_table['jdct']
+    t = np.asarray(jd_array, dtype=np.float64)
+    row = np.clip(np.searchsorted(jdct, t, side='right') - 1, 0, len(jdct) - 1)
+    position, velocity = kepler_propagate({name: elements_table[name][row] for name in ('ec', 'qr', 'in', 'om', 'w', 'tp', 'n')}, t)
+    return OrbitTable.from_states(t, position, velocity)
+
+@profiled('kepler')
+def report_kepler_drift(run):
+    # A coast ends at the first burn after the elements' epoch, or where the craft leaves the region in which
+    # the center dominates: beyond that two-body elements about the center are meaningless
+    center_body = CENTER_BODIES.get(run.center)
+    primary = 'EARTH' if center_body is not None and center_body['name'] == 'MOON' else 'MOON'
+    primary_table = run.orbits.get(primary, {}).get('vectors')
+    for planet, data in run.orbits.items():
+        if 'elements' not in data or len(data['elements']) == 0 or 'vectors' not in data or len(data['vectors']) == 0:
+            continue
+        vectors = data['vectors']
+        jdct = vectors['jdct']
+        try:
+            propagated = propagate_elements(data['elements'], jdct)
+        except ValueError as e:
+            print_error(f"Can't propagate the elements of {planet}: {e}")
+            continue
+        position, _ = vectors.state_arrays()
+        error = np.linalg.norm(propagated.state_arrays()[0] - position, axis=1)
+
+        start = data['elements']['jdct'][0]
+        coast_end, ending = jdct[-1], 'the end'
+        burns = [event['start_jd'] for event in run.events
+                 if event['type'] == 'burn' and event['body'] == planet and event['start_jd'] > start]
+        if burns and min(burns) < coast_end:
+            coast_end, ending = min(burns), 'the first burn'
+        if center_body is not None and planet != primary:
+            _, _, _, known, elsewhere = dominant_body_states(vectors, center_body, primary_table)
+            departures = np.flatnonzero((jdct > start) & (elsewhere | ~known))
+            if len(departures) and jdct[departures[0]] < coast_end:
+                coast_end = jdct[departures[0]]
+                ending = f"{'leaving' if center_body['name'] == 'MOON' else 'entering'} the Moon's sphere of influence"
+        coast = (jdct >= start) & (jdct <= coast_end)
+        beyond = np.flatnonzero((jdct >= start) & (error > kepler_tolerance_km))
+        usable_days = (jdct[beyond[0]] if len(beyond) else jdct[-1]) - start
+
+        print(f"Kepler propagation of {planet} from JD {start:.6f}: max drift {np.max(error[coast], initial=0):.3f} km "
+              f"up to {ending} ({coast_end - start:.2f} d), "
+              f"{np.max(error):.1f} km overall; within {kepler_tolerance_km} km for {usable_days:.2f} d")
+
+# Osculating elements from vectors, the inverse of kepler_propagate: the fields of print_elements in Horizons'
+# units (km, degrees, JD, deg/s, seconds) at every vectors epoch, with the GM of the run's center. For
+# hyperbolic orbits A is negative and AD and PR are infinite, as in Horizons; MA is then the hyperbolic mean
+# anomaly. Tp is the last periapsis passage at or before the epoch (the next one on an inbound hyperbola).
+# --element-series writes them to <orbits_file>_elements.json.
+
+element_series = False
+ELEMENT_SERIES_FIELDS = [name for name in ELEMENT_FIELDS if name != 'date']
+
+def elements_from_vectors(jdct, position, velocity, gm):
+    r = np.linalg.norm(position, axis=1)
+    v2 = np.einsum('ij,ij->i', velocity, velocity)
+    radial = np.einsum('ij,ij->i', position, velocity)
+    h = np.cross(position, velocity)
+    h_norm = np.linalg.norm(h, axis=1)
+    e_vector = ((v2 - gm / r)[:, np.newaxis] * position - radial[:, np.newaxis] * velocity) / gm
+    e = np.linalg.norm(e_vector, axis=1)
+    a = 1 / (2 / r - v2 / gm)
+
+    # The ascending node is along z x h; equatorial orbits take the x axis as their node
+    node = np.column_stack((-h[:, 1], h[:, 0], np.zeros(len(r))))
+    node_norm = np.linalg.norm(node, axis=1)
+    equatorial = node_norm < 1e-12 * h_norm
+    node[equatorial] = (1.0, 0.0, 0.0)
+    node /= np.where(equatorial, 1.0, node_norm)[:, np.newaxis]
+    h_unit = h / h_norm[:, np.newaxis]
+    normal = np.cross(h_unit, node)  # in the orbit plane, 90 degrees ahead of the node
+
+    inclination = np.degrees(np.arccos(np.clip(h_unit[:, 2], -1, 1)))
+    om = np.degrees(np.arctan2(node[:, 1], node[:, 0])) % 360
+    w = np.degrees(np.arctan2(np.einsum('ij,ij->i', e_vector, normal), np.einsum('ij,ij->i', e_vector, node))) % 360
+    nu = np.arctan2(np.einsum('ij,ij->i', np.cross(e_vector, position), h_unit), np.einsum('ij,ij->i', e_vector, position))
+
+    mean_motion = np.sqrt(gm / np.abs(a)**3)  # rad/s
+    M = np.empty(len(r))
+    elliptic = e < 1
+    ee, nn = e[elliptic], nu[elliptic]
+    E = np.arctan2(np.sqrt(1 - ee * ee) * np.sin(nn), ee + np.cos(nn))
+    M[elliptic] = (E - ee * np.sin(E)) % (2 * np.pi)
+    ee, nn = e[~elliptic], nu[~elliptic]
+    H = np.arcsinh(np.sqrt(ee * ee - 1) * np.sin(nn) / (1 + ee * np.cos(nn)))
+    M[~elliptic] = ee * np.sinh(H) - H
+
+    return {
+        'jdct': jdct,
+        'ec': e,
+        'qr': h_norm**2 / (gm * (1 + e)),  # a (1 - e) without the cancellation near e = 1
+        'in': inclination,
+        'om': om,
+        'w': w,
+        'tp': jdct - M / mean_motion / SECONDS_PER_DAY,
+        'n': np.degrees(mean_motion),
+        'ma': np.degrees(M),
+        'ta': np.degrees(nu) % 360,
+        'a': a,
+        'ad': np.where(elliptic, a * (1 + e), np.inf),
+        'pr': np.where(elliptic, 2 * np.pi / mean_motion, np.inf),
+    }
+
+@profiled('elements')
+def compute_element_series(run):
+    center_body = CENTER_BODIES.get(run.center)
+    if center_body is None:
+        print_error(f"No GM known for center {run.center}; skipping the element series")
+        return False
+
+    run.element_series = {}
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data or len(data['vectors']) == 0:
+            continue
+        vectors = data['vectors']
+        position, velocity = vectors.state_arrays()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns = elements_from_vectors(vectors['jdct'], position, velocity, center_body['gm'])
+        run.element_series[planet] = OrbitTable(columns)
+    print_debug("Element series for %s", ', '.join(run.element_series))
+    return True
+
+@profiled('write elements', outputs=lambda run: [f"{run.orbits_file}_elements.json"])
+def save_orbit_data_elements(run):
+    # Columnar like the orbit JSON: {"center": ..., "gm": ..., "bodies": {planet: {field: [...]}}}
+    elements_file = f"{run.orbits_file}_elements.json"
+    center_body = CENTER_BODIES[run.center]
+    try:
+        os.makedirs(os.path.dirname(elements_file), exist_ok=True)
+        with open(elements_file, 'w') as fh:
+            fh.write(f'{{"version": 1, "center": {json.dumps(center_body["name"])}, "gm": {center_body["gm"]!r}, "bodies": {{')
+            for i, (planet, table) in enumerate(run.element_series.items()):
+                fh.write(f"{',' if i else ''}\n  {json.dumps(planet)}: ")
+                write_json_table(fh, table, json_significant_digits)
+            fh.write("\n}}\n")
+        print_debug("Element series written to %s", elements_file)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing to {elements_file}: {e}")
+    return False
+
+# Level-of-detail pyramid: every body's path simplified by Douglas-Peucker at several tolerances, so that a
+# viewer showing W km over P pixels can draw the coarsest level whose tolerance is below W / P. One pass per
+# body records for every sample the largest tolerance at which Douglas-Peucker keeps it, each clamped to that
+# of the split that exposed it; a level is then the samples whose value exceeds its tolerance.
+
+lod_tolerances_km = []  # --lod-km; no pyramid unless tolerances are given
+
+def douglas_peucker_significance(points, min_tolerance):
+    # points is (n, 3); samples that only matter below min_tolerance keep 0, the endpoints get inf. All open
+    # segments of one depth of the recursion are split together, so the Python loop runs once per depth.
+    significance = np.zeros(len(points))
+    significance[[0, -1]] = np.inf
+    first, last, parent = np.array([0]), np.array([len(points) - 1]), np.array([np.inf])
+    while len(first):
+        open_segments = last - first >= 2
+        first, last, parent = first[open_segments], last[open_segments], parent[open_segments]
+        if len(first) == 0:
+            break
+
+        # The inner samples of all segments back to back, with the segment each belongs to
+        counts = last - first - 1
+        starts = np.cumsum(counts) - counts
+        segment = np.repeat(np.arange(len(first)), counts)
+        inner = np.arange(counts.sum()) - starts[segment] + first[segment] + 1
+
+        chord = points[last] - points[first]
+        length2 = np.einsum('ij,ij->i', chord, chord)
+        offsets = points[inner] - points[first][segment]
+        along = np.einsum('ij,ij->i', offsets, chord[segment]) / np.where(length2 > 0, length2, 1)[segment]
+        along = np.clip(along, 0, 1)
+        distance = np.linalg.norm(offsets - along[:, np.newaxis] * chord[segment], axis=1)
+
+        # The first sample at the largest distance of every segment, like np.argmax
+        largest = np.maximum.reduceat(distance, starts)
+        candidates = np.flatnonzero(distance == largest[segment])
+        _, first_candidate = np.unique(segment[candidates], return_index=True)
+        split = inner[candidates[first_candidate]]
+
+        splitting = largest > min_tolerance
+        split, largest = split[splitting], largest[splitting]
+        first, last, parent = first[splitting], last[splitting], parent[splitting]
+        significance[split] = np.minimum(largest, parent)
+        first, last = np.concatenate((first, split)), np.concatenate((split, last))
+        parent = np.concatenate((significance[split], significance[split]))
+    return significance
+
+@profiled('lod')
+def build_lod_pyramid(run):
+    run.lod = {}
+    for planet, data in run.orbits.items():
+        if 'vectors' not in data or len(data['vectors']) < 2:
+            continue
+        position, _ = data['vectors'].state_arrays()
+        run.lod[planet] = douglas_peucker_significance(position, min(lod_tolerances_km))
+
+@profiled('write lod', outputs=lambda run: [f"{run.orbits_file}_lod.json"])
+def save_orbit_data_lod(run):
+    # {"levels": [{"tolerance_km": t, "bodies": {planet: {"span": [first jd, last jd], "jdct": [...], "x": [...],
+    # "y": [...], "z": [...]}}}, ...]}, coarsest level first
+    lod_file = f"{run.orbits_file}_lod.json"
+    number_format = f"%.{json_significant_digits}g"
+    try:
+        os.makedirs(os.path.dirname(lod_file), exist_ok=True)
+        with open(lod_file, 'w') as fh:
+            fh.write('{"version": 1, "levels": [')
+            for i, tolerance in enumerate(sorted(lod_tolerances_km, reverse=True)):
+                wall, start = time.perf_counter(), fh.tell()
+                fh.write(f"{',' if i else ''}\n  {{\"tolerance_km\": {tolerance!r}, \"bodies\": {{")
+                points = 0
+                for j, (planet, significance) in enumerate(run.lod.items()):
+                    kept = np.flatnonzero(significance > tolerance)
+                    points += len(kept)
+                    vectors = run.orbits[planet]['vectors']
+                    jdct = vectors['jdct'][kept]
+                    fh.write(f"{',' if j else ''}\n    {json.dumps(planet)}: {{\"span\": [{jdct[0]:.9f}, {jdct[-1]:.9f}]")
+                    for field in ('jdct', 'x', 'y', 'z'):
+                        fh.write(f", {json.dumps(field)}: ")
+                        write_json_column(fh, vectors[field][kept], "%.9f" if field == 'jdct' else number_format)
+                    fh.write("}")
+                fh.write("\n  }}")
+                total = sum(len(run.orbits[planet]['vectors']) for planet in run.lod)
+                print(f"LOD level {tolerance:g} km: {points} of {total} points ({100 * points / total:.1f}%), "
+                      f"{(fh.tell() - start) / 1e6:.2f} MB in {(time.perf_counter() - wall) * 1000:.1f} ms")
+            fh.write("\n]}\n")
+        print_debug("LOD pyramid written to %s", lod_file)
+        return True
+    except IOError as e:
+        print_error(f"IOError when writing to {lod_file}: {e}")
+    return False
+
+# Conjunction screening: every local minimum of the distance between two bodies that comes within
+# conjunction_km. Time is cut into bins; in each bin every body's Hermite path lies in a box, and one sweep
+# over the boxes of all bins sorted along x (bins are offset apart in x) yields the pairs whose boxes overlap
+# in x, y and z. Only those pairs and bins are sampled, and the minima refined where d|dp|^2/dt = 2 dp.dv
+# changes sign. The cost follows the pairs that come close, not the number of pairs times the samples.
+
+conjunction_km = None  # screening is off unless a distance is given
+conjunction_bin_minutes = 5.0  # short enough that a low lunar orbit only sweeps a small box per bin
+CONJUNCTION_BATCH = 4096  # candidate (pair, bin)s sampled at a time
+
+def path_boxes(table, t0, bin_days, nbins):
+    # Lower and upper corners, (nbins, 3) each, of boxes holding the body's Hermite path in every bin; bins
+    # without data get empty boxes. Between two samples the cubic leaves the chord by at most
+    # 4/27 dt (|v0 - c| + |v1 - c|), c being the chord velocity.
+    jdct = table['jdct']
+    position, velocity = table.state_arrays()
+    dt = np.diff(jdct) * SECONDS_PER_DAY
+    chord = np.diff(position, axis=0) / dt[:, np.newaxis]
+    bulge = 4 / 27 * dt * (np.linalg.norm(velocity[:-1] - chord, axis=1) + np.linalg.norm(velocity[1:] - chord, axis=1))
+    lower = np.minimum(position[:-1], position[1:]) - bulge[:, np.newaxis]
+    upper = np.maximum(position[:-1], position[1:]) + bulge[:, np.newaxis]
+
+    low, high = np.full((nbins, 3), np.inf), np.full((nbins, 3), -np.inf)
+    # bin_days is at least the longest step, so an interval touches the bins of its two ends only
+    for ends in (jdct[:-1], jdct[1:]):
+        bins = np.clip(np.floor((ends - t0) / bin_days).astype(np.int64), 0, nbins - 1)
+        np.minimum.at(low, bins, lower)
+        np.maximum.at(high, bins, upper)
+    return low, high
+
+def sweep_overlapping_boxes(low, high):
+    # low and high are (nbodies, nbins, 3); returns the (body, other body, bin) triples whose boxes overlap
+    nbodies, nbins, _ = low.shape
+    body, bin_index = (index.ravel() for index in np.indices((nbodies, nbins)))
+    low, high = low.reshape(-1, 3), high.reshape(-1, 3)
+    filled = low[:, 0] <= high[:, 0]
+    body, bin_index, low, high = body[filled], bin_index[filled], low[filled], high[filled]
+    if len(body) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+
+    x_min = low[:, 0].min()
+    width = high[:, 0].max() - x_min + 1
+    start = low[:, 0] - x_min + bin_index * width
+    end = high[:, 0] - x_min + bin_index * width
+    order = np.argsort(start, kind='stable')
+    start, end = start[order], end[order]
+
+    # Box i overlaps in x the boxes after it in the sweep order that start before it ends
+    stop = np.searchsorted(start, end, side='right')
+    counts = np.maximum(stop - np.arange(len(start)) - 1, 0)
+    i = np.repeat(np.arange(len(start)), counts)
+    j = i + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i, j = order[i], order[j]
+    overlap = np.all((low[i, 1:] <= high[j, 1:]) & (low[j, 1:] <= high[i, 1:]), axis=1)
+    i, j = i[overlap], j[overlap]
+    return np.column_stack((np.minimum(body[i], body[j]), np.maximum(body[i], body[j]), bin_index[i]))
+
+def interpolate_grouped(tables, which, t):
+    # Positions and velocities of body which[k] at t[k], interpolating every body's table once
+    position, velocity = np.empty(t.shape + (3,)), np.empty(t.shape + (3,))
+    for body in np.unique(which):
+        rows = which == body
+        position[rows], velocity[rows] = interpolate_vectors(tables[body], t[rows])
+    return position, velocity
+
+def refine_conjunctions(tables, candidates, t0, bin_days, samples, threshold):
+    # candidates are (body, other body, bin) triples; returns rows of (body, other, jd, distance, speed)
+    body, other, bin_index = candidates.T
+    span_start = np.maximum([tables[b]['jdct'][0] for b in body], [tables[b]['jdct'][0] for b in other])
+    span_stop = np.minimum([tables[b]['jdct'][-1] for b in body], [tables[b]['jdct'][-1] for b in other])
+    bin_start = np.maximum(t0 + bin_index * bin_days, span_start)
+    bin_stop = np.minimum(t0 + (bin_index + 1) * bin_days, span_stop)
+    usable = bin_start < bin_stop
+    body, other, bin_start, bin_stop = body[usable], other[usable], bin_start[usable], bin_stop[usable]
+
+    # The samples of a bin include both of its ends, so a minimum between two samples is seen in one bin only
+    t = bin_start[:, np.newaxis] + (bin_stop - bin_start)[:, np.newaxis] * np.linspace(0, 1, samples)
+    pairs = np.broadcast_to(body[:, np.newaxis], t.shape).ravel(), np.broadcast_to(other[:, np.newaxis], t.shape).ravel()
+    position, velocity = interpolate_grouped(tables, pairs[0], t.ravel())
+    other_position, other_velocity = interpolate_grouped(tables, pairs[1], t.ravel())
+    closing = np.einsum('ij,ij->i', position - other_position, velocity - other_velocity).reshape(t.shape)
+
+    k, j = np.nonzero((closing[:, :-1] < 0) & (closing[:, 1:] >= 0))
+    jd = t[k, j] - closing[k, j] * (t[k, j + 1] - t[k, j]) / (closing[k, j + 1] - closing[k, j])
+    position, velocity = interpolate_grouped(tables, body[k], jd)
+    other_position, other_velocity = interpolate_grouped(tables, other[k], jd)
+    distance = np.linalg.norm(position - other_position, axis=1)
+    speed = np.linalg.norm(velocity - other_velocity, axis=1)
+    close = distance <= threshold
+    return body[k][close], other[k][close], jd[close], distance[close], speed[close]
+
+def screen_conjunctions(tables, threshold, bin_minutes):
+    # tables is a list of vectors tables; returns the conjunctions as (body, other, jd, distance km, relative
+    # speed km/s) arrays, body < other indexing tables
+    steps = [np.max(np.diff(table['jdct'])) for table in tables]
+    bin_days = max(bin_minutes / 1440.0, *steps)
+    t0 = min(table['jdct'][0] for table in tables)
+    nbins = max(1, int(np.ceil((max(table['jdct'][-1] for table in tables) - t0) / bin_days)))
+
+    boxes = [path_boxes(table, t0, bin_days, nbins) for table in tables]
+    low = np.stack([box[0] for box in boxes]) - threshold / 2
+    high = np.stack([box[1] for box in boxes]) + threshold / 2
+    candidates = sweep_overlapping_boxes(low, high)
+
+    samples = int(np.ceil(bin_days / min(steps))) + 1
+    results = [refine_conjunctions(tables, candidates[i:i + CONJUNCTION_BATCH], t0, bin_days, samples, threshold)
+               for i in range(0, len(candidates), CONJUNCTION_BATCH)]
+    print_debug("Conjunction screening: %s bodies, %s bins, %s candidate pairs and bins", len(tables), nbins, len(candidates))
+    if not results:
+        return tuple(np.empty(0) for _ in range(5))
+    return tuple(np.concatenate(columns) for columns in zip(*results))
+
+@profiled('conjunctions')
+def find_conjunctions(run):
+    planets = [planet for planet, data in run.orbits.items() if 'vectors' in data and len(data['vectors']) >= 2]
+    if len(planets) < 2:
+        return
+    body, other, jd, distance, speed = screen_conjunctions([run.orbits[planet]['vectors'] for planet in planets],
+                                                           conjunction_km, conjunction_bin_minutes)
+    for b, o, t, d, v in zip(body.tolist(), other.tolist(), jd.tolist(), distance.tolist(), speed.tolist()):
+        run.events.append({'type': 'conjunction', 'body': planets[b], 'other': planets[o], 'jd': t,
+                           'distance': d, 'relative_speed': v})
+    run.events.sort(key=lambda event: event.get('jd', event.get('start_jd')))
+    print(f"Found {len(jd)} conjunctions within {conjunction_km} km among {', '.join(planets)}")
+
+# CPU process pool: with --cpu-workers N the (body, table) pairs of a run are parsed, and their columns
+# formatted for the orbit JSON, in N worker processes. Arrays cross between processes through shared memory
+# blocks, named in the task and its result, rather than being pickled. On a single CPU, or with fewer than two
+# tables, the pool can't win back the copies into and out of shared memory, so the work stays in process.
+
+cpu_workers = 1
+cpu_executor = None
+
+def use_cpu_pool(ntasks):
+    return cpu_workers > 1 and (os.cpu_count() or 1) > 1 and ntasks >= 2
+
+def get_cpu_executor():
+    global cpu_executor
+    if cpu_executor is None:
+        cpu_executor = ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context('spawn'))
+    return cpu_executor
+
+def shutdown_cpu_executor():
+    global cpu_executor
+    if cpu_executor is not None:
+        cpu_executor.shutdown()
+        cpu_executor = None
+
+def share_array(array):
+    # Copies array into a new shared memory block; returns the block and a picklable (name, dtype, shape)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.dtype, array.shape)
+
+def attach_array(descriptor):
+    name, dtype, shape = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def parse_table_worker(code, paths):
+    # Runs in a worker: parses one table and leaves it in a shared memory block for the parent to unlink
+    array = parse_horizons_stream(iter_stitched_lines(paths), code)
+    block, descriptor = share_array(array)
+    block.close()
+    return descriptor
+
+def parse_all_tables(run):
+    tasks = [(planet, code) for planet in run.planets for code in ('elements', 'vectors')
+             if f"{code}_chunks" in run.orbits_raw.get(planet, {})]  # the Earth has none with --selenocentric-from-geo
+    if not use_cpu_pool(len(tasks)):
+        for planet, code in tasks:
+            parse_horizons_elements(run, code, planet)
+        return
+
+    wall, cpu = time.perf_counter(), time.thread_time()
+    futures = [get_cpu_executor().submit(parse_table_worker, code, run.orbits_raw[planet][f"{code}_chunks"])
+               for planet, code in tasks]
+    rows = 0
+    for (planet, code), future in zip(tasks, futures):
+        block, array = attach_array(future.result())
+        try:
+            # Copy every column out of the block; from_array would keep views of single-row tables
+            table = OrbitTable({name: array[name].copy() for name in array.dtype.names})
+            rows += len(store_parsed_table(run, code, planet, table))
+        finally:
+            del array
+            block.close()
+            block.unlink()
+        print_debug("Found %s %s records for planet %s", len(run.orbits[planet][code]), code, planet)
+
+    if profiling:
+        nbytes = sum(path_size(path) for planet, code in tasks for path in run.orbits_raw[planet][f"{code}_chunks"])
+        profile_record('parse', time.perf_counter() - wall, time.thread_time() - cpu, len(tasks), rows, nbytes)
+
+def json_table_worker(descriptor, digits, part_path):
+    # Runs in a worker: formats one table held in shared memory as its JSON object, into part_path
+    block, array = attach_array(descriptor)
+    try:
+        with open(part_path, 'w') as fh:
+            write_json_table(fh, array, digits)
+    finally:
+        del array
+        block.close()
+    return part_path
+
+def export_json_tables(run, parts_dir):
+    # Formats every table of the run in the pool; returns {(planet, table name): part file}
+    blocks = []
+    futures = {}
+    try:
+        for i, (planet, data) in enumerate(run.orbits.items()):
+            for name in ('elements', 'vectors'):
+                if name not in data:
+                    continue
+                table = data[name]
+                array = table.to_array(np.dtype([(field, table[field].dtype) for field in table.fields]))
+                block, descriptor = share_array(array)
+                blocks.append(block)
+                part_path = os.path.join(parts_dir, f"{i}-{name}.json")
+                futures[planet, name] = get_cpu_executor().submit(json_table_worker, descriptor, json_significant_digits, part_path)
+        return {key: future.result() for key, future in futures.items()}
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+# Batch mode: several phases in one invocation. Their Horizons queries are fetched once into the cache by the
+# parent, then each phase is parsed and written by its own worker process from the cached responses.
+
+write_binary = False
+write_tiles = False
+phase_workers = None  # defaults to one worker per phase, up to the CPU count
+
+# Module settings a worker process needs to reproduce the parent's command line
+PROCESS_SETTINGS = ['use_cached_data', 'log_level', 'profiling', 'horizons_url', 'max_concurrency', 'fetch_retries',
+                    'fetch_backoff_seconds', 'fetch_timeout_seconds', 'chunk_days', 'cache_dir', 'cache_max_bytes',
+                    'binary_precision', 'tile_days', 'decimation_tolerance_km', 'densify_step_minutes',
+                    'chebyshev_interval_days', 'chebyshev_degree', 'write_binary', 'write_tiles',
+                    'json_legacy', 'json_significant_digits', 'json_compression', 'cpu_workers',
+                    'append_mode', 'append_tolerance_km', 'stop_time_override', 'selenocentric_from_geo',
+                    'selenocentric_check', 'selenocentric_tolerance_km', 'selenocentric_frame',
+                    'kepler_reporting', 'kepler_tolerance_km', 'element_series', 'lod_tolerances_km',
+                    'conjunction_km', 'conjunction_bin_minutes']
+
+def run_phase(phase, data_dir, raw_dir=None):
+    run = PhaseRun(phase, data_dir, raw_dir)
+    if run.invalid:
+        print_error(run.invalid)
+        return False
+    print_config(run)
+
+    print_debug("Using a JD of %s for start time: %s-%s-%s %s:%s", run.jd, run.start_year, run.start_month, run.start_day, run.start_hour, run.start_minute)
+
+    if append_mode:
+        if densify_step_minutes is not None or decimation_tolerance_km is not None:
+            print_error("--append can't be combined with --densify-minutes or --decimate-km")
+            return False
+        if selenocentric_frame != 'ecliptic' and run.center == JPL_MOON_CENTER:
+            print_error("--append needs the archive in the ecliptic frame; drop --selenocentric-frame")
+            return False
+        if not load_archive_for_append(run):
+            return False
+
+    if not fetch_all_horizons_data(run, fetch_jobs(run)):
+        print_error(f"Failed to fetch Horizons data for {phase}.")
+        return False
+
+    if not save_fetched_data(run):
+        print_error(f"Failed to save fetched data for {phase}.")
+        return False
+
+    parse_all_tables(run)
+    if derives_selenocentric(run) and not derive_selenocentric_vectors(run):
+        return False
+    for raw in run.orbits_raw.values():
+        raw.clear()  # the typed tables are all the writers need
+
+    if not append_archived_vectors(run):
+        return False
+
+    if densify_step_minutes is not None:
+        densify_orbits(run, densify_step_minutes)
+
+    if decimation_tolerance_km is not None:
+        decimate_orbits(run, decimation_tolerance_km)
+
+    derived = compute_derived_quantities(run)  # from the inertial vectors, before any rotation
+    if derived and conjunction_km is not None:
+        find_conjunctions(run)
+    if kepler_reporting:
+        report_kepler_drift(run)
+    series = element_series and compute_element_series(run)
+    if run.archived and not start_append_segment(run):
+        return True
+    if series:
+        if save_orbit_data_elements(run):
+            print("Element series saved successfully")
+        else:
+            print("Failed to save the element series")
+    rotate_selenocentric_frame(run)
+
+    save_orbit_data(run)
+    save_orbit_data_json(run)
+
+    if append_orbit_data_npy(run) if run.archived else save_orbit_data_npy(run):
+        print("NPY data saved successfully")
+    else:
+        print("Failed to save NPY data")
+
+    if derived:
+        if save_orbit_data_derived(run):
+            print("Derived quantities saved successfully")
+        else:
+            print("Failed to save derived quantities")
+
+    if write_binary:
+        if save_orbit_data_binary(run):
+            print("Binary data saved successfully")
+        else:
+            print("Failed to save binary data")
+
+    if lod_tolerances_km:
+        build_lod_pyramid(run)
+        if save_orbit_data_lod(run):
+            print("LOD pyramid saved successfully")
+        else:
+            print("Failed to save the LOD pyramid")
+
+    if chebyshev_interval_days is not None:
+        if save_orbit_data_chebyshev(run):
+            print("Chebyshev segments saved successfully")
+        else:
+            print("Failed to save Chebyshev segments")
+
+    if write_tiles:
+        if save_orbit_data_tiles(run):
+            print("Tiles saved successfully")
+        else:
+            print("Failed to save tiles")
+
+    if run.archived and record_append_segment(run):
+        print(f"Segment {os.path.basename(run.orbits_file)} listed in {segments_file(run.archive_base)}")
+
+    return True
+
+def run_phase_in_worker(phase, data_dir, settings):
+    # Returns the status and this phase's profile stages, which the parent merges into its own
+    globals().update(settings)
+    setup_logging(log_level)
+    profile_stages.clear()  # a worker process may be reused for another phase
+    return run_phase(phase, data_dir, os.path.join(data_dir, phase)), profile_stages
+
+def run_phases(phases, data_dir):
+    # Fetch the distinct queries of all phases once, then process the phases in parallel from the cache.
+    # The phases share body names, so each one's raw ho-*.txt dumps go to a subdirectory named after it.
+    runs = [PhaseRun(phase, data_dir) for phase in phases]
+    for run in runs:
+        if run.invalid:
+            print_error(run.invalid)
+    if any(run.invalid for run in runs):
+        return False
+    if append_mode and not all(load_archive_for_append(run) for run in runs):
+        return False
+    if not prefetch_horizons_data(runs):
+        return False
+
+    settings = {name: globals()[name] for name in PROCESS_SETTINGS}
+    settings['use_cached_data'] = True  # everything the workers need is in the cache now
+
+    workers = min(len(phases), phase_workers or os.cpu_count() or 1)
+    if workers > 1:
+        settings['cpu_workers'] = 1  # the phases are already spread over processes
+    if workers <= 1:
+        globals().update(settings)
+        return all([run_phase(phase, data_dir, os.path.join(data_dir, phase)) for phase in phases])
+
+    print_debug("Processing %s phases in %s worker processes", len(phases), workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {phase: executor.submit(run_phase_in_worker, phase, data_dir, settings) for phase in phases}
+        statuses = []
+        for phase, future in futures.items():
+            try:
+                status, stages = future.result()
+                merge_profile(stages)
+                statuses.append(status)
+            except Exception as e:
+                print_error(f"Phase {phase} failed: {e}")
+                statuses.append(False)
+    return all(statuses)
+
 def main():
     global phase, use_cached_data, data_dir
-
+    global horizons_url, max_concurrency, fetch_retries, chunk_days
+    global cache_dir, cache_max_bytes, binary_precision, tile_days, decimation_tolerance_km
+    global densify_step_minutes, chebyshev_interval_days, chebyshev_degree
+    global write_binary, write_tiles, phase_workers, log_level, profiling
+    global json_legacy, json_significant_digits, json_compression, cpu_workers
+    global append_mode, append_tolerance_km, stop_time_override
+    global selenocentric_from_geo, selenocentric_check, selenocentric_tolerance_km, selenocentric_frame
+    global kepler_reporting, kepler_tolerance_km, element_series, lod_tolerances_km
+    global conjunction_km, conjunction_bin_minutes
+
+    started = time.perf_counter()
     print("Running ...")
 
     parser = argparse.ArgumentParser(description="Orbit data fetcher and processor")
     parser.add_argument("--phase", choices=['geo', 'lro', 'lunar', 'landing'], default='geo', help="Phase of the mission")
-    parser.add_argument("--use-cache", action="store_true", help="Use cached data")
+    parser.add_argument("--phases", help="Run several phases in one batch: 'all' or a comma separated list, e.g. geo,lunar")
+    parser.add_argument("--workers", type=int, default=phase_workers, help="Worker processes for --phases (defaults to one per phase, up to the CPU count)")
+    parser.add_argument("--cpu-workers", type=int, default=cpu_workers, help="Worker processes that parse the tables and format the orbit JSON (1 does it all in this process)")
+    parser.add_argument("--use-cache", action="store_true", help="Use cached Horizons responses only; never fetch")
+    parser.add_argument("--append", action="store_true", help="Only fetch vectors after the last epoch in the existing archive and append them")
+    parser.add_argument("--append-tolerance-km", type=float, default=append_tolerance_km, help="Largest position difference accepted where appended vectors overlap the archive")
+    parser.add_argument("--selenocentric-from-geo", action="store_true", help="Derive Moon-centred vectors from geocentric ones of the bodies and the Moon")
+    parser.add_argument("--selenocentric-check", action="store_true", help="Also fetch the Moon-centred vectors directly and compare them with the derived ones")
+    parser.add_argument("--selenocentric-tolerance-km", type=float, default=selenocentric_tolerance_km, help="Largest position difference accepted by --selenocentric-check")
+    parser.add_argument("--selenocentric-frame", choices=['ecliptic', 'moon-fixed'], default=selenocentric_frame, help="Axes of the Moon-centred vectors in the outputs")
+    parser.add_argument("--kepler-report", action="store_true", help="Report how far Kepler propagation of the fetched elements drifts from the fetched vectors")
+    parser.add_argument("--kepler-tolerance-km", type=float, default=kepler_tolerance_km, help="Drift up to which --kepler-report counts a propagated coast as usable")
+    parser.add_argument("--element-series", action="store_true", help="Also write osculating elements at every vectors epoch, computed from the vectors")
+    parser.add_argument("--lod-km", default="", help="Comma separated Douglas-Peucker tolerances in km of a path pyramid, e.g. 1,10,100,1000")
+    parser.add_argument("--conjunction-km", type=float, default=conjunction_km, help="Add every close approach between two bodies within this distance to the derived events")
+    parser.add_argument("--conjunction-bin-minutes", type=float, default=conjunction_bin_minutes, help="Length of the time bins of the conjunction screening")
+    parser.add_argument("--stop-time", help="Stop time instead of the configured one: 'YYYY-MM-DD HH:MM' (UT) or 'now'; only open-ended phases are extended")
     parser.add_argument("--data-dir", default=data_dir, help="Data directory")
+    parser.add_argument("--horizons-url", default=horizons_url, help="Horizons batch endpoint (e.g. a local stand-in serving canned responses)")
+    parser.add_argument("--max-concurrency", type=int, default=max_concurrency, help="Maximum number of Horizons requests in flight")
+    parser.add_argument("--retries", type=int, default=fetch_retries, help="Retries per Horizons request, with exponential backoff")
+    parser.add_argument("--chunk-days", type=float, default=chunk_days, help="Split vector ranges into sub-windows of this many days (0 disables)")
+    parser.add_argument("--cache-dir", default=cache_dir, help="Directory of the Horizons response cache")
+    parser.add_argument("--json-legacy", action="store_true", help="Write the orbit JSON in the old one-object-per-record layout")
+    parser.add_argument("--json-digits", type=int, default=json_significant_digits, help="Significant digits of the numbers in the orbit JSON (Julian dates keep 1e-9 d)")
+    parser.add_argument("--json-compress", default=",".join(json_compression), help="Also write compressed copies of the orbit JSON: gz, br or gz,br")
+    parser.add_argument("--binary", action="store_true", help="Also write orbit data in the compact binary format")
+    parser.add_argument("--binary-precision", type=int, choices=[32, 64], default=binary_precision, help="Bits per vector component in the binary file")
+    parser.add_argument("--densify-minutes", type=float, default=densify_step_minutes, help="Resample fetched vectors at this finer step by Hermite interpolation")
+    parser.add_argument("--decimate-km", type=float, default=decimation_tolerance_km, help="Drop vector samples that Hermite interpolation reproduces within this many km (output steps become non-uniform)")
+    parser.add_argument("--chebyshev-days", type=float, default=chebyshev_interval_days, help="Also write vectors as Chebyshev segments of this many days")
+    parser.add_argument("--chebyshev-degree", type=int, default=chebyshev_degree, help="Degree of the Chebyshev segments")
+    parser.add_argument("--tiles", action="store_true", help="Also write vectors as time tiles with a manifest")
+    parser.add_argument("--tile-days", type=float, default=tile_days, help="Length of a time tile in days")
+    parser.add_argument("--log-level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper, default=log_level, help="Least severe log messages shown")
+    parser.add_argument("--profile", nargs='?', const='', metavar="REPORT_JSON", help="Print per-stage timings, sizes and peak RSS at the end; optionally also write them to REPORT_JSON")
+    parser.add_argument("--cache-max-mb", type=float, default=cache_max_bytes / (1024 * 1024), help="Size limit of the Horizons response cache in MB")
     
     args = parser.parse_args()
 
     phase = args.phase
+    phases = list(config) if args.phases == 'all' else args.phases.split(',') if args.phases else [phase]
+    for p in phases:
+        if p not in config:
+            parser.error(f"unknown phase {p} (choose from {', '.join(config)})")
     use_cached_data = args.use_cache
     data_dir = args.data_dir
+    horizons_url = args.horizons_url
+    max_concurrency = max(1, args.max_concurrency)
+    fetch_retries = max(0, args.retries)
+    chunk_days = args.chunk_days
+    cache_dir = args.cache_dir
+    cache_max_bytes = int(args.cache_max_mb * 1024 * 1024)
+    binary_precision = args.binary_precision
+    tile_days = args.tile_days
+    decimation_tolerance_km = args.decimate_km
+    densify_step_minutes = args.densify_minutes
+    chebyshev_interval_days = args.chebyshev_days
+    chebyshev_degree = args.chebyshev_degree
+    write_binary = args.binary
+    write_tiles = args.tiles
+    phase_workers = args.workers
+    cpu_workers = max(1, args.cpu_workers)
+    append_mode = args.append
+    selenocentric_from_geo = args.selenocentric_from_geo
+    selenocentric_check = args.selenocentric_check
+    selenocentric_tolerance_km = args.selenocentric_tolerance_km
+    selenocentric_frame = args.selenocentric_frame
+    kepler_reporting = args.kepler_report
+    element_series = args.element_series
+    conjunction_km = args.conjunction_km
+    conjunction_bin_minutes = args.conjunction_bin_minutes
+    try:
+        lod_tolerances_km = [float(tolerance) for tolerance in args.lod_km.split(',') if tolerance]
+    except ValueError:
+        parser.error(f"--lod-km takes comma separated numbers, not {args.lod_km}")
+    if any(tolerance <= 0 for tolerance in lod_tolerances_km):
+        parser.error("--lod-km tolerances must be positive")
+    kepler_tolerance_km = args.kepler_tolerance_km
+    append_tolerance_km = args.append_tolerance_km
+    if args.stop_time == 'now':
+        stop_time_override = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+    elif args.stop_time:
+        try:
+            stop_time_override = parse_horizons_time(args.stop_time)
+        except ValueError as e:
+            parser.error(str(e))
+    json_legacy = args.json_legacy
+    json_significant_digits = args.json_digits
+    json_compression = [fmt for fmt in args.json_compress.split(',') if fmt]
+    for fmt in json_compression:
+        if fmt not in ('gz', 'br'):
+            parser.error(f"unknown compression {fmt} (choose from gz, br)")
+    log_level = args.log_level
+    profiling = args.profile is not None
+    setup_logging(log_level)
 
     if not os.path.exists(data_dir):
         try:
@@ -611,48 +2875,31 @@ def main():
             print_error(f"Unable to create data directory {data_dir}: {e}")
             sys.exit(1)
 
-    init_config(phase)
-    print_config()
-
-    set_start_and_stop_times()
-
-    print_debug(f"Using a JD of {jd} for start time: {start_year}-{start_month}-{start_day} {start_hour}:{start_minute}")
-
-    if use_cached_data:
-        load_cached_data()
+    try:
+        if len(phases) == 1:
+            status = run_phase(phases[0], data_dir)
+        else:
+            status = run_phases(phases, data_dir)
+    finally:
+        shutdown_cpu_executor()
 
-    for planet in planets:
-        if not use_cached_data:
-            if not fetch_elements(planet):
-                print_error(f"Failed to fetch elements for {planet}. Exiting.")
-                sys.exit(1)
-            
-            if not fetch_horizons_data(planet, {
-                'table_type': 'vectors',
-                'range': 1,
-                'start_time': get_horizons_start_time(planet),
-                'stop_time': get_horizons_stop_time(planet),
-                'step_size': step_size
-            }):
-                print_error(f"Failed to fetch vector data for {planet}. Exiting.")
-                sys.exit(1)
-        
-    if not use_cached_data:
-        if not save_fetched_data():
-            print_error("Failed to save fetched data. Exiting.")
-            sys.exit(1)
-    
-    for planet in planets:
-        parse_horizons_elements('elements', planet)
-        parse_horizons_elements('vectors', planet)
+    # Only now, with every chunk of every phase parsed, may the cache drop files
+    evict_horizons_cache()
 
-    save_orbit_data()
-    save_orbit_data_json()
+    if profiling:
+        report = profile_report(time.perf_counter() - started)
+        print_profile(report)
+        if args.profile:
+            try:
+                with open(args.profile, 'w') as fh:
+                    json.dump(report, fh, indent=2)
+                print(f"Profile report written to {args.profile}")
+            except IOError as e:
+                print_error(f"IOError when writing to {args.profile}: {e}")
 
-    if save_orbit_data_npy():
-        print("NPY data saved successfully")
-    else:
-        print("Failed to save NPY data")
+    if not status:
+        print_error("Failed to process Horizons data. Exiting.")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,603 @@
+# Copyright (c) 2024 Sankaranarayanan Viswanathan. All rights reserved.
+
+# Benchmarks for the orbits.py data pipeline, run against synthetic Horizons responses. Nothing touches the
+# network: the pipeline benchmark serves the responses through a stand-in for the requests session. Timings can
+# be saved as JSON and compared against a baseline recorded earlier on the same machine to catch regressions.
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import re
+import shutil
+import tempfile
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+import numpy as np
+
+import orbits
+
+EPOCH_JD = 2460139.890972222  # 2023-Jul-14 09:23 TDB, start of the geo phase
+
+fixture_dir = tempfile.mkdtemp(prefix="orbits-bench-")
+atexit.register(shutil.rmtree, fixture_dir, ignore_errors=True)
+
+def write_fixture(name, content):
+    # Responses reach the parser as files, just like entries of the Horizons cache
+    path = os.path.join(fixture_dir, name)
+    with open(path, 'w') as fh:
+        fh.write(content)
+    return path
+
+def horizons_vectors_response(jdct, position, velocity, seed=0):
+    # A Horizons VECTORS CSV response with the given states; LT, RG and RR carry filler values
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(scale=1e-9, size=len(jdct))
+    rows = [f"{t:.9f}, A.D. 2023-Jul-14 09:23:00.0000, {a:.15E}, {b:.15E}, {c:.15E}, "
+            f"{d:.15E}, {e:.15E}, {f:.15E}, {n:.15E}, {r:.15E}, {n:.15E},"
+            for t, (a, b, c), (d, e, f), n, r in zip(jdct, position, velocity, noise, np.linalg.norm(position, axis=1))]
+    return ("*******************************************************************************\n"
+            "Ephemeris / API_USER\n"
+            "$$SOE\n" + "\n".join(rows) + "\n$$EOE\n"
+            "*******************************************************************************\n")
+
+def horizons_epochs(start_jd, nrows, step_minutes=1):
+    # Horizons gives JDTDB to 9 decimals, so evenly spaced epochs come back with steps that differ by ~1e-9 d
+    return np.round(start_jd + np.arange(nrows) * step_minutes / 1440.0, 9)
+
+def synthetic_vectors_table(nrows, step_minutes=1, seed=0, start_jd=EPOCH_JD):
+    # A Horizons VECTORS CSV response for a craft on a slowly precessing elliptical orbit
+    jdct = horizons_epochs(start_jd, nrows, step_minutes)
+    rate = 2 * np.pi / (0.5 * 86400)  # rad/s, a 12 hour orbit
+    phase = rate * (jdct - EPOCH_JD) * 86400
+    position = np.column_stack((2.4e4 * np.cos(phase), 1.8e4 * np.sin(phase), 3.0e3 * np.sin(phase / 3)))
+    velocity = np.column_stack((-2.4e4 * rate * np.sin(phase), 1.8e4 * rate * np.cos(phase), 1.0e3 * rate * np.cos(phase / 3)))
+    return horizons_vectors_response(jdct, position, velocity, seed)
+
+def kepler_states(t, a, e, gm, inclination_deg=21.0):
+    # Two-body states at t seconds past periapsis on ellipses of semi-major axis a and eccentricity e
+    n = np.sqrt(gm / a**3)
+    M = n * t
+    E = M.copy()
+    for _ in range(30):
+        E -= (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+    b = a * np.sqrt(1 - e * e)
+    denominator = 1 - e * np.cos(E)
+    x, y = a * (np.cos(E) - e), b * np.sin(E)
+    vx, vy = -a * n * np.sin(E) / denominator, b * n * np.cos(E) / denominator
+    i = np.radians(inclination_deg)
+    return (np.column_stack((x, y * np.cos(i), y * np.sin(i))),
+            np.column_stack((vx, vy * np.cos(i), vy * np.sin(i))))
+
+def synthetic_geo_table(nrows, step_minutes=1, apogees_km=(36500, 41700, 51400, 71400, 127600)):
+    # CY3 in Earth orbit: a 170 km perigee and an apogee raised by an impulsive burn at evenly spaced
+    # periapsis passages. Returns the response and the burn epochs.
+    gm, perigee = orbits.CENTER_BODIES[orbits.JPL_EARTH_CENTER]['gm'], 6371.0 + 170
+    jdct = horizons_epochs(EPOCH_JD, nrows, step_minutes)
+    a = np.array([(perigee + 6371.0 + apogee) / 2 for apogee in apogees_km])
+    e = 1 - perigee / a
+    period_days = 2 * np.pi * np.sqrt(a**3 / gm) / 86400
+
+    spacing = (jdct[-1] - EPOCH_JD) / len(apogees_km)
+    burns = []
+    for k in range(len(apogees_km) - 1):
+        previous = burns[-1] if burns else EPOCH_JD
+        burns.append(previous + max(1, round(spacing / period_days[k])) * period_days[k])
+    burns = np.array(burns)
+
+    segment = np.searchsorted(burns, jdct, side='right')
+    periapsis_jd = np.r_[EPOCH_JD, burns][segment]
+    position, velocity = kepler_states((jdct - periapsis_jd) * 86400, a[segment], e[segment], gm)
+    return horizons_vectors_response(jdct, position, velocity), burns
+
+def synthetic_elements_table(jdct=EPOCH_JD):
+    values = [1.2e-01, 1.7e+04, 2.1e+01, 3.4e+02, 1.8e+02, jdct - 0.1, 2.3e-03, 1.3e+01, 2.4e+01, 1.9e+04, 2.2e+04, 1.5e+05]
+    row = f"{jdct:.9f}, A.D. 2023-Jul-14 09:23:00.0000, " + ", ".join(f"{v:.15E}" for v in values) + ","
+    return "$$SOE\n" + row + "\n$$EOE\n"
+
+def load_synthetic_orbits(nrows, bodies=("MOON", "CY3"), output_dir=fixture_dir):
+    # A geo phase run whose bodies were parsed from synthetic responses instead of fetched ones
+    run = orbits.PhaseRun('geo', output_dir)
+    for i, body in enumerate(bodies):
+        run.orbits_raw[body] = {
+            'elements_chunks': [write_fixture(f"{body}-elements.txt", synthetic_elements_table())],
+            'vectors_chunks': [write_fixture(f"{body}-vectors.txt", synthetic_vectors_table(nrows, seed=i))],
+        }
+        orbits.parse_horizons_elements(run, 'elements', body)
+        orbits.parse_horizons_elements(run, 'vectors', body)
+        run.orbits_raw[body].clear()
+    return run
+
+def legacy_parse_vectors(content):
+    # The original line-by-line parser, kept here as the reference point
+    parse = False
+    vectors = []
+    for line in content.split('\n'):
+        if line.startswith('$$SOE'):
+            parse = True
+            continue
+        if line.startswith('$$EOE'):
+            parse = False
+            continue
+        if parse:
+            fields = re.findall(r'(?:[^,"]|"(?:\\.|[^"])*")+', line)
+            fields = [field.strip().strip('"') for field in fields]
+            if len(fields) != 11:
+                continue
+            jdct, date, x, y, z, vx, vy, vz, lt, rg, rr = fields
+            vectors.append({'jdct': jdct, 'x': x, 'y': y, 'z': z, 'vx': vy, 'vy': vx, 'vz': vz})
+    return vectors
+
+def best_time(fn, *args, repeat=3, setup=None):
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+# Best times of this session by benchmark name, written out by --results and compared by --baseline
+bench_results = {}
+
+# Timings only compare on the same hardware: --results records the machine, and --baseline skips the comparison
+# against results from another one
+MACHINE_IDENTITY = ('node', 'processor', 'cpus')
+
+def machine_description():
+    return {'node': platform.node(), 'platform': platform.platform(), 'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__}
+
+def record(name, seconds):
+    bench_results[name] = seconds
+    return seconds
+
+def bench_parse(nrows, repeat):
+    content = synthetic_vectors_table(nrows)
+    run = orbits.PhaseRun('geo', fixture_dir)
+    run.orbits_raw['BENCH'] = {'vectors_chunks': [write_fixture("BENCH-vectors.txt", content)]}
+
+    def parse_into_orbits():
+        run.orbits.clear()
+        orbits.parse_horizons_elements(run, 'vectors', 'BENCH')
+
+    results = {
+        'legacy regex parser': best_time(legacy_parse_vectors, content, repeat=repeat),
+        'parse_horizons_table': best_time(orbits.parse_horizons_table, content, 'vectors', repeat=repeat),
+        'parse_horizons_elements': best_time(parse_into_orbits, repeat=repeat),  # streamed from a file
+    }
+
+    print(f"Parsing a {nrows}-row VECTORS table ({len(content) / 1e6:.1f} MB), best of {repeat}:")
+    baseline = results['legacy regex parser']
+    for name, seconds in results.items():
+        record(f"parse/{name}/{nrows}", seconds)
+        print(f"  {name:<26} {seconds * 1000:9.1f} ms  {baseline / seconds:6.1f}x")
+
+def bench_binary(nrows, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        run = load_synthetic_orbits(nrows, output_dir=tmp)
+        json_file, binary_file = f"{run.orbits_file}.json", f"{run.orbits_file}.bin"
+
+        def save_json(legacy):
+            with mock.patch.object(orbits, 'json_legacy', legacy), mock.patch.object(orbits, 'json_compression', ['gz']):
+                orbits.save_orbit_data_json(run)
+
+        formats = [
+            ('JSON legacy', lambda: save_json(True), json_file, lambda: json.load(open(json_file))),
+            ('JSON', lambda: save_json(False), json_file, lambda: json.load(open(json_file))),
+            ('binary', lambda: orbits.save_orbit_data_binary(run), binary_file, lambda: orbits.load_orbit_data_binary(binary_file)),
+        ]
+
+        print(f"Orbit export of 2 bodies x {nrows} vectors, best of {repeat} (JSON timings include gzip):")
+        print(f"  {'format':<12} {'size':>10} {'gzipped':>10} {'write':>10} {'load':>10}")
+        for name, write, path, load in formats:
+            write_seconds = record(f"export/{name} write/{nrows}", best_time(write, repeat=repeat))
+            load_seconds = record(f"export/{name} load/{nrows}", best_time(load, repeat=repeat))
+            gzipped = f"{os.path.getsize(path + '.gz') / 1e6:7.2f} MB" if os.path.exists(path + '.gz') else ""
+            print(f"  {name:<12} {os.path.getsize(path) / 1e6:7.2f} MB {gzipped:>10} {write_seconds * 1000:7.1f} ms {load_seconds * 1000:7.1f} ms")
+            if os.path.exists(path + '.gz'):
+                os.remove(path + '.gz')
+
+        # Round trip: the binary file must reproduce the in-memory tables to its stored precision, and the
+        # columnar JSON to its significant digits
+        loaded = orbits.load_orbit_data_binary(binary_file)
+        columnar = json.load(open(json_file))['bodies']
+        for body, data in run.orbits.items():
+            for table_name, table in data.items():
+                for column, values in loaded[body][table_name].items():
+                    tolerance = 1e-6 * np.abs(table[column]).max() if values.dtype.itemsize == 4 else 0
+                    assert np.abs(values - table[column]).max() <= tolerance, f"{body} {table_name} {column}"
+                    if column != 'date':
+                        error = np.abs(np.array(columnar[body][table_name][column]) - table[column])
+                        assert np.all(error <= 10.0 ** -(orbits.json_significant_digits - 1) * np.abs(table[column]) + 1e-9), column
+
+def bench_state_at(nrows, nqueries, repeat):
+    run = load_synthetic_orbits(nrows, bodies=("CY3",))
+    jdct = run.orbits['CY3']['vectors']['jdct']
+    rng = np.random.default_rng(0)
+    random_epochs = rng.uniform(jdct[0], jdct[-1], nqueries)
+    sorted_epochs = np.sort(random_epochs)
+
+    # A table with gaps takes the binary search path
+    gappy = run.orbits['CY3']['vectors'].row_slice(0, nrows)
+    gappy = orbits.OrbitTable({name: np.delete(column, slice(1, nrows - 1, 7)) for name, column in gappy.columns.items()})
+    assert run.orbits['CY3']['vectors'].uniform_step() is not None and gappy.uniform_step() is None
+
+    print(f"state_at over a {nrows}-row table, {nqueries} epochs, best of {repeat}:")
+    for name, fn in [
+        ('uniform step, random', lambda: orbits.state_at(run, 'CY3', random_epochs)),
+        ('uniform step, sorted', lambda: orbits.state_at(run, 'CY3', sorted_epochs)),
+        ('uneven step, random', lambda: orbits.interpolate_vectors(gappy, random_epochs)),
+    ]:
+        print(f"  {name:<22} {record(f'state_at/{name}/{nrows}', best_time(fn, repeat=repeat)) * 1000:9.1f} ms")
+
+def bench_derived(repeat):
+    # A full geo run: both bodies sampled every minute over the whole phase
+    with tempfile.TemporaryDirectory() as tmp:
+        run = orbits.PhaseRun('geo', tmp)
+        nrows = int((run.stop_time_gm - run.start_time_gm) / 60) + 1
+        cy3_content, burns = synthetic_geo_table(nrows)
+        jdct = horizons_epochs(EPOCH_JD, nrows)
+        moon_position, moon_velocity = kepler_states((jdct - EPOCH_JD) * 86400, 384400.0, 0.0549,
+                                                     orbits.CENTER_BODIES[orbits.JPL_EARTH_CENTER]['gm'], 5.1)
+        # LRO coasting in a 100 km lunar orbit, seen from the Earth: no burns, though its geocentric energy swings
+        lro_position, lro_velocity = kepler_states((jdct - EPOCH_JD) * 86400, 1737.4 + 100, 0.0,
+                                                   orbits.CENTER_BODIES[orbits.JPL_MOON_CENTER]['gm'], 90.0)
+        for body, content in (("MOON", horizons_vectors_response(jdct, moon_position, moon_velocity)), ("CY3", cy3_content),
+                              ("LRO", horizons_vectors_response(jdct, moon_position + lro_position, moon_velocity + lro_velocity))):
+            run.orbits_raw[body] = {'vectors_chunks': [write_fixture(f"{body}-geo-vectors.txt", content)]}
+            orbits.parse_horizons_elements(run, 'vectors', body)
+
+        def per_sample_loop():
+            # What the viewer does today: distance and speed one sample at a time
+            altitudes, speeds = [], []
+            for body in run.orbits:
+                position, velocity = run.orbits[body]['vectors'].state_arrays()
+                for p, v in zip(position.tolist(), velocity.tolist()):
+                    altitudes.append((p[0] * p[0] + p[1] * p[1] + p[2] * p[2]) ** 0.5 - 6371.0)
+                    speeds.append((v[0] * v[0] + v[1] * v[1] + v[2] * v[2]) ** 0.5)
+
+        loop_seconds = best_time(per_sample_loop, repeat=repeat)
+        derive_seconds = record(f"derived/compute/{nrows}", best_time(orbits.compute_derived_quantities, run, repeat=repeat))
+        write_seconds = record(f"derived/write/{nrows}", best_time(orbits.save_orbit_data_derived, run, repeat=repeat))
+        found = [event['start_jd'] for event in run.events if event['type'] == 'burn' and event['body'] == 'CY3']
+        assert len(found) == len(burns) and np.all(np.abs(np.array(found) - burns) < 2 / 1440.0), found
+        assert not [event for event in run.events if event['type'] == 'burn' and event['body'] == 'LRO']
+
+        # The same Earth-orbit arcs seen from the Moon, as in the lunar phase: the burns and nothing else
+        lunar = orbits.PhaseRun('lunar', tmp)
+        cy3_position, cy3_velocity = run.orbits['CY3']['vectors'].state_arrays()
+        for body, content in (("CY3", horizons_vectors_response(jdct, cy3_position - moon_position, cy3_velocity - moon_velocity)),
+                              ("EARTH", horizons_vectors_response(jdct, -moon_position, -moon_velocity))):
+            lunar.orbits_raw[body] = {'vectors_chunks': [write_fixture(f"{body}-lunar-vectors.txt", content)]}
+            orbits.parse_horizons_elements(lunar, 'vectors', body)
+        orbits.compute_derived_quantities(lunar)
+        found = [event['start_jd'] for event in lunar.events if event['type'] == 'burn']
+        assert len(found) == len(burns) and np.all(np.abs(np.array(found) - burns) < 2 / 1440.0), found
+
+        counts = {}
+        for event in run.events:
+            counts[event['type']] = counts.get(event['type'], 0) + 1
+        print(f"Derived quantities of a geo run, 3 bodies x {nrows} vectors, best of {repeat}:")
+        print(f"  {'per-sample r/speed loop':<26} {loop_seconds * 1000:9.1f} ms")
+        print(f"  {'compute_derived_quantities':<26} {derive_seconds * 1000:9.1f} ms  {loop_seconds / derive_seconds:6.1f}x")
+        print(f"  {'save_orbit_data_derived':<26} {write_seconds * 1000:9.1f} ms  "
+              f"{os.path.getsize(f'{run.orbits_file}_derived.json') / 1e6:.1f} MB")
+        print(f"  events: {', '.join(f'{count} {kind}' for kind, count in sorted(counts.items()))}")
+
+# The pipeline benchmark: several bodies' responses fetched through a stand-in requests session into an empty
+# cache, loaded again from the cache, parsed and written out, at table sizes from 1k to 1M rows per body
+
+PIPELINE_BODIES = ["CY3", "LRO", "MOON", "EARTH", "VIKRAM", "MARS"]
+EPOCH = datetime(2023, 7, 14, 9, 23)  # EPOCH_JD in UTC; the synthetic tables ignore the TDB offset
+
+def horizons_param(params, name):
+    return params[name].strip("'")
+
+class FakeHorizonsResponse:
+    # Just what horizons_download uses of a streamed requests.Response
+    status_code = 200
+    encoding = 'utf-8'
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, chunk_size=None, decode_unicode=False):
+        with open(self.path) as fh:
+            for line in fh:
+                yield line.rstrip("\n")
+
+class FakeHorizonsSession:
+    # Answers Horizons queries from fixture files prepared by add_response
+    def __init__(self):
+        self.responses = {}
+
+    def add_response(self, params, content):
+        key = json.dumps(sorted(params.items()))
+        self.responses[key] = write_fixture(f"response-{len(self.responses)}.txt", content)
+
+    def get(self, url, params=None, timeout=None, stream=False):
+        return FakeHorizonsResponse(self.responses[json.dumps(sorted(params.items()))])
+
+def pipeline_jobs(nrows, nbodies):
+    stop = EPOCH + timedelta(minutes=nrows - 1)
+    return [(body, options) for body in PIPELINE_BODIES[:nbodies] for options in (
+        {'table_type': 'elements'},
+        {'table_type': 'vectors', 'range': True, 'step_size': '1 m',
+         'start_time': orbits.format_horizons_time(EPOCH), 'stop_time': orbits.format_horizons_time(stop)},
+    )]
+
+def synthetic_response(params, seed):
+    if 'TLIST' in params:
+        return synthetic_elements_table(float(horizons_param(params, 'TLIST')))
+    start = orbits.parse_horizons_time(horizons_param(params, 'START_TIME'))
+    stop = orbits.parse_horizons_time(horizons_param(params, 'STOP_TIME'))
+    nrows = int((stop - start) / timedelta(minutes=1)) + 1
+    return synthetic_vectors_table(nrows, seed=seed, start_jd=EPOCH_JD + (start - EPOCH) / timedelta(days=1))
+
+def bench_pipeline(nrows, nbodies, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        run = orbits.PhaseRun('geo', os.path.join(tmp, "output"))
+        run.planets = PIPELINE_BODIES[:nbodies]
+        run.jd = EPOCH_JD
+        jobs = pipeline_jobs(nrows, nbodies)
+
+        session = FakeHorizonsSession()
+        for seed, (body, options) in enumerate(jobs):
+            for params in orbits.horizons_chunk_params(run, body, options):
+                session.add_response(params, synthetic_response(params, seed))
+
+        cache = os.path.join(tmp, "cache")
+        with mock.patch.object(orbits, 'get_horizons_session', return_value=session), \
+             mock.patch.object(orbits, 'cache_dir', cache):
+            def load_from_cache():
+                assert orbits.fetch_all_horizons_data(run, jobs)
+                for body in run.planets:
+                    for key in ('elements', 'vectors'):
+                        for _ in orbits.horizons_lines(run, body, key):
+                            pass
+
+            def parse():
+                run.orbits.clear()
+                for body in run.planets:
+                    orbits.parse_horizons_elements(run, 'elements', body)
+                    orbits.parse_horizons_elements(run, 'vectors', body)
+
+            timings = {
+                'fetch (mocked)': best_time(orbits.fetch_all_horizons_data, run, jobs, repeat=repeat,
+                                            setup=lambda: shutil.rmtree(cache, ignore_errors=True)),
+                'cache load': best_time(load_from_cache, repeat=repeat),
+                'parse_horizons_elements': best_time(parse, repeat=repeat),
+            }
+            os.makedirs(run.data_dir, exist_ok=True)
+            for writer in (orbits.save_orbit_data_json, orbits.save_orbit_data_npy, orbits.save_orbit_data):
+                timings[writer.__name__] = best_time(writer, run, repeat=repeat)
+            assert all(len(run.orbits[body]['vectors']) == nrows for body in run.planets)
+
+        print(f"Pipeline over {nbodies} bodies x {nrows} vectors, best of {repeat}:")
+        for name, seconds in timings.items():
+            record(f"pipeline/{name}/{nbodies}x{nrows}", seconds)
+            print(f"  {name:<26} {seconds * 1000:9.1f} ms  {seconds * 1e9 / (nbodies * nrows):8.0f} ns/row")
+
+def bench_kepler(nepochs, repeat):
+    # kepler_propagate over nepochs epochs against the analytic ellipse of kepler_states, and on a hyperbola
+    # against the conservation of energy and of angular momentum; elements_from_vectors as its inverse
+    gm = orbits.CENTER_BODIES[orbits.JPL_MOON_CENTER]['gm']
+    a, e = 1737.4 + 1500, 0.35
+    jdct = EPOCH_JD + np.linspace(0, 30, nepochs)
+    elements = {'ec': e, 'qr': a * (1 - e), 'in': 21.0, 'om': 0.0, 'w': 0.0, 'tp': EPOCH_JD,
+                'n': np.degrees(np.sqrt(gm / a**3))}
+    expected_position, expected_velocity = kepler_states((jdct - EPOCH_JD) * 86400, a, e, gm)
+    position, velocity = orbits.kepler_propagate(elements, jdct)
+    position_error = np.max(np.linalg.norm(position - expected_position, axis=1))
+    velocity_error = np.max(np.linalg.norm(velocity - expected_velocity, axis=1))
+    assert position_error < 1e-6, position_error
+
+    q, e_h = 1737.4 + 100, 1.8
+    a_h = q / (e_h - 1)
+    hyperbola = dict(elements, ec=e_h, qr=q, om=40.0, w=130.0, n=np.degrees(np.sqrt(gm / a_h**3)))
+    jd_h = EPOCH_JD + np.linspace(-2, 2, nepochs)
+    position_h, velocity_h = orbits.kepler_propagate(hyperbola, jd_h)
+    r = np.linalg.norm(position_h, axis=1)
+    energy = np.einsum('ij,ij->i', velocity_h, velocity_h) / 2 - gm / r
+    momentum = np.linalg.norm(np.cross(position_h, velocity_h), axis=1)
+    energy_error = np.max(np.abs(energy - gm / (2 * a_h))) / (gm / (2 * a_h))
+    momentum_error = np.max(np.abs(momentum / np.sqrt(gm * a_h * (e_h**2 - 1)) - 1))
+    assert energy_error < 1e-9 and momentum_error < 1e-9 and abs(r.min() - q) < 1e-3
+
+    recovered = orbits.elements_from_vectors(jdct, position, velocity, gm)
+    recovered_h = orbits.elements_from_vectors(jd_h, position_h, velocity_h, gm)
+    elements_error = max(np.max(np.abs(recovered['ec'] - e)), np.max(np.abs(recovered_h['ec'] - e_h)),
+                         np.max(np.abs(recovered['qr'] / elements['qr'] - 1)), np.max(np.abs(recovered_h['qr'] / q - 1)),
+                         np.max(np.abs(recovered['in'] - 21.0)) / 21.0, np.max(np.abs(recovered_h['tp'] - EPOCH_JD)))
+    assert elements_error < 1e-9, elements_error
+
+    timings = {
+        'ellipse': best_time(orbits.kepler_propagate, elements, jdct, repeat=repeat),
+        'hyperbola': best_time(orbits.kepler_propagate, hyperbola, jd_h, repeat=repeat),
+        'to elements': best_time(orbits.elements_from_vectors, jdct, position, velocity, gm, repeat=repeat),
+    }
+    print(f"Kepler propagation of {nepochs} epochs, best of {repeat}:")
+    for name, seconds in timings.items():
+        record(f"kepler/{name}/{nepochs}", seconds)
+        print(f"  {name:<12} {seconds * 1000:9.1f} ms  {seconds * 1e9 / nepochs:6.0f} ns/epoch")
+    print(f"  ellipse against the analytic orbit: {position_error * 1e6:.3f} mm, {velocity_error * 1e6:.3e} mm/s")
+    print(f"  hyperbola: relative energy drift {energy_error:.1e}, angular momentum drift {momentum_error:.1e}")
+    print(f"  elements recovered from the vectors to {elements_error:.1e} (ec, relative qr and in, tp in days)")
+
+def bench_lod(nrows, tolerances, repeat):
+    # Douglas-Peucker significance of the synthetic geo orbit and the size of every pyramid level
+    content, _ = synthetic_geo_table(nrows)
+    position, _ = orbits.OrbitTable.from_array(orbits.parse_horizons_table(content, 'vectors')).state_arrays()
+    seconds = record(f"lod/significance/{nrows}",
+                     best_time(orbits.douglas_peucker_significance, position, min(tolerances), repeat=repeat))
+    significance = orbits.douglas_peucker_significance(position, min(tolerances))
+    print(f"LOD pyramid of a {nrows}-sample geo orbit, built in {seconds * 1000:.1f} ms (best of {repeat}):")
+    for tolerance in sorted(tolerances, reverse=True):
+        kept = np.count_nonzero(significance > tolerance)
+        print(f"  {tolerance:8g} km {kept:9d} points {100 * kept / nrows:6.2f}%")
+
+def bench_conjunctions(nbodies, days, threshold, repeat):
+    # Screening of nbodies lunar orbiters on random low orbits, sampled every minute for days, against a
+    # refinement of every pair over every bin without the sweep
+    gm = orbits.CENTER_BODIES[orbits.JPL_MOON_CENTER]['gm']
+    rng = np.random.default_rng(3)
+    jdct = EPOCH_JD + np.arange(int(days * 1440) + 1) / 1440.0
+    tables = []
+    for _ in range(nbodies):
+        q = 1737.4 + rng.uniform(50, 150)
+        e = rng.uniform(0, 0.05)
+        a = q / (1 - e)
+        elements = {'ec': e, 'qr': q, 'in': rng.uniform(0, 180), 'om': rng.uniform(0, 360), 'w': rng.uniform(0, 360),
+                    'tp': EPOCH_JD + rng.uniform(0, 0.1), 'n': np.degrees(np.sqrt(gm / a**3))}
+        tables.append(orbits.OrbitTable.from_states(jdct, *orbits.kepler_propagate(elements, jdct)))
+
+    seconds = record(f"conjunctions/screen/{nbodies}x{days}d",
+                     best_time(orbits.screen_conjunctions, tables, threshold, orbits.conjunction_bin_minutes, repeat=repeat))
+    body, other, jd, distance, _ = orbits.screen_conjunctions(tables, threshold, orbits.conjunction_bin_minutes)
+
+    bin_days = orbits.conjunction_bin_minutes / 1440.0
+    nbins = int(np.ceil((jdct[-1] - jdct[0]) / bin_days))
+    pairs = [(i, j) for i in range(nbodies) for j in range(i + 1, nbodies)]
+    everything = np.array([(i, j, k) for i, j in pairs for k in range(nbins)])
+    wall = time.perf_counter()
+    reference = [orbits.refine_conjunctions(tables, everything[i:i + orbits.CONJUNCTION_BATCH], jdct[0], bin_days,
+                                            int(round(bin_days * 1440)) + 1, threshold)
+                 for i in range(0, len(everything), orbits.CONJUNCTION_BATCH)]
+    brute_seconds = time.perf_counter() - wall
+    reference_jd = np.sort(np.concatenate([columns[2] for columns in reference]))
+    assert np.array_equal(np.sort(jd), reference_jd), (len(jd), len(reference_jd))
+
+    print(f"Conjunctions within {threshold} km among {nbodies} orbiters over {days} days at 1 min "
+          f"({len(pairs)} pairs x {len(jdct)} epochs):")
+    print(f"  sweep and refine {seconds * 1000:9.1f} ms, {len(jd)} events, closest {np.min(distance, initial=np.inf):.3f} km")
+    print(f"  every pair       {brute_seconds * 1000:9.1f} ms, the same events")
+
+def bench_cpu_pool(nrows, nbodies, worker_counts, repeat):
+    # Parse and the columnar JSON export of nbodies synthetic bodies with the tables spread over a process pool.
+    # The pool is used even where orbits.py would stay in process (a single CPU), so that its cost shows.
+    with tempfile.TemporaryDirectory() as tmp:
+        run = orbits.PhaseRun('geo', os.path.join(tmp, "output"))
+        run.planets = PIPELINE_BODIES[:nbodies]
+        chunks = {}
+        for i, body in enumerate(run.planets):
+            chunks[body] = {
+                'elements_chunks': [write_fixture(f"{body}-elements.txt", synthetic_elements_table())],
+                'vectors_chunks': [write_fixture(f"{body}-vectors.txt", synthetic_vectors_table(nrows, seed=i))],
+            }
+        os.makedirs(run.data_dir, exist_ok=True)
+        nbytes = sum(os.path.getsize(path) for body in chunks.values() for paths in body.values() for path in paths)
+
+        def parse():
+            run.orbits.clear()
+            run.orbits_raw.update({body: dict(paths) for body, paths in chunks.items()})
+            orbits.parse_all_tables(run)
+
+        timings = {}
+        reference = None
+        for workers in worker_counts:
+            with mock.patch.object(orbits, 'cpu_workers', workers), \
+                 mock.patch.object(orbits, 'use_cpu_pool', lambda ntasks, workers=workers: workers > 1):
+                try:
+                    parse()  # starts the pool outside the timings
+                    timings[workers] = (best_time(parse, repeat=repeat),
+                                        best_time(orbits.save_orbit_data_json, run, repeat=repeat))
+                finally:
+                    orbits.shutdown_cpu_executor()
+            with open(f"{run.orbits_file}.json", 'rb') as fh:
+                output = fh.read()
+            assert reference is None or output == reference, f"JSON written by {workers} workers differs"
+            reference = output
+
+        print(f"Parse and JSON export of {nbodies} bodies x {nrows} vectors ({nbytes / 1e6:.1f} MB of responses) "
+              f"over {os.cpu_count()} CPUs, best of {repeat}:")
+        print(f"  {'workers':>7} {'parse ms':>10} {'json ms':>10} {'total ms':>10} {'speedup':>8}")
+        serial = sum(timings[worker_counts[0]])
+        for workers, (parse_seconds, json_seconds) in timings.items():
+            record(f"cpu_pool/parse/{workers}/{nbodies}x{nrows}", parse_seconds)
+            record(f"cpu_pool/json/{workers}/{nbodies}x{nrows}", json_seconds)
+            total = parse_seconds + json_seconds
+            print(f"  {workers:7d} {parse_seconds * 1000:10.1f} {json_seconds * 1000:10.1f} {total * 1000:10.1f} {serial / total:7.2f}x")
+        if max(worker_counts) > (os.cpu_count() or 1):
+            print(f"  Note: more workers than the {os.cpu_count()} CPUs here only add the shared memory copies; "
+                  f"orbits.py stays in process on a single CPU")
+
+def compare_with_baseline(baseline_file, tolerance):
+    # Returns the benchmarks that got slower than the baseline by more than the tolerance
+    with open(baseline_file) as fh:
+        stored = json.load(fh)
+    baseline = stored['results']
+    machine, here = stored.get('machine'), machine_description()
+    if machine is not None and any(machine.get(key) != here[key] for key in MACHINE_IDENTITY):
+        print(f"Not comparing with {baseline_file}: it was recorded on {machine.get('node')} ({machine.get('processor')}, "
+              f"{machine.get('cpus')} CPUs), this is {here['node']} ({here['processor']}, {here['cpus']} CPUs). "
+              f"Record a baseline here with --results first.")
+        return []
+
+    regressions = []
+    print(f"Compared with {baseline_file} (tolerance {tolerance:.0%}):")
+    for name, seconds in bench_results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+        print(f"  {name:<52} {baseline[name] * 1000:9.1f} ms -> {seconds * 1000:9.1f} ms  {ratio:5.2f}x"
+              f"{'  REGRESSION' if slower else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for orbits.py")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows in the synthetic vectors table")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions per measurement; the best is reported")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated rows per body for the pipeline benchmark, up to 1000000")
+    parser.add_argument("--bodies", type=int, default=3, choices=range(1, len(PIPELINE_BODIES) + 1), help="Bodies in the pipeline benchmark")
+    parser.add_argument("--cpu-workers", default="1,2,4,8", help="Comma separated worker counts for the process pool benchmark")
+    parser.add_argument("--only", choices=['parse', 'binary', 'state_at', 'derived', 'pipeline', 'cpu_pool', 'kepler', 'lod', 'conjunctions'], action='append', help="Run only these benchmarks (repeatable)")
+    parser.add_argument("--results", help="Write the timings to this JSON file")
+    parser.add_argument("--baseline", help="Compare the timings with those of an earlier --results file from this machine")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown against the baseline reported as a regression")
+    args = parser.parse_args()
+
+    benchmarks = {
+        'parse': lambda: bench_parse(args.rows, args.repeat),
+        'binary': lambda: bench_binary(args.rows, args.repeat),
+        'state_at': lambda: bench_state_at(args.rows, 1000000, args.repeat),
+        'derived': lambda: bench_derived(args.repeat),
+        'pipeline': lambda: [bench_pipeline(int(size), args.bodies, args.repeat) for size in args.sizes.split(',')],
+        'kepler': lambda: bench_kepler(1000000, args.repeat),
+        'lod': lambda: bench_lod(args.rows, [0.1, 1, 10, 100, 1000], args.repeat),
+        'conjunctions': lambda: bench_conjunctions(20, 30, 20.0, args.repeat),
+        'cpu_pool': lambda: bench_cpu_pool(args.rows, len(PIPELINE_BODIES), [int(n) for n in args.cpu_workers.split(',')], args.repeat),
+    }
+    for name, bench in benchmarks.items():
+        if not args.only or name in args.only:
+            bench()
+
+    if args.results:
+        os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+        with open(args.results, 'w') as fh:
+            json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'repeat': args.repeat,
+                       'machine': machine_description(), 'results': bench_results}, fh, indent=2)
+            fh.write("\n")
+        print(f"Results written to {args.results}")
+
+    if args.baseline and compare_with_baseline(args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()